@@ -0,0 +1,72 @@
+"""Caches resolved affiliations on disk, so reruns only resolve new strings"""
+
+import json
+import sqlite3
+import hashlib
+import logging
+import unicodedata
+
+# Max number of keys per SELECT, keeps below sqlite's bound parameter limit
+QUERY_CHUNK_SIZE = 500
+
+
+def normalise_affiliation(affiliation: str) -> str:
+    """Normalises an affiliation for use as a cache key. Case is kept
+    because spacey's entity recognition is case sensitive.
+    e.g. ' Dept. of  Medicine,\\tUCL ' -> 'Dept. of Medicine, UCL'"""
+    return " ".join(unicodedata.normalize("NFC", affiliation).split())
+
+def matching_config_version(settings: dict) -> str:
+    """Hashes everything that affects how an affiliation is resolved, so that
+    changing a threshold, model or reference data set invalidates the cache."""
+    serialised = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode("utf-8")).hexdigest()[:16]
+
+def open_cache(file_path: str, logger: logging.Logger) -> sqlite3.Connection:
+    """Opens (creating if needed) the sqlite affiliation cache"""
+    logger.info(f"Opening affiliation cache {file_path}..")
+    connection = sqlite3.connect(file_path)
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS resolutions (
+               config_version TEXT NOT NULL,
+               affiliation TEXT NOT NULL,
+               country TEXT,
+               institution TEXT,
+               grid_id TEXT,
+               PRIMARY KEY (config_version, affiliation)
+           )"""
+    )
+    # Caches created before institutions were resolved to GRID ids
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(resolutions)")]
+    if "grid_id" not in columns:
+        connection.execute("ALTER TABLE resolutions ADD COLUMN grid_id TEXT")
+    connection.commit()
+    return connection
+
+def load_resolutions(connection: sqlite3.Connection, version: str, keys: list[str], logger: logging.Logger) -> dict:
+    """Returns {key: (country, institution, grid_id)} for every key already
+    resolved under this config version"""
+    logger.info(f"Looking up {len(keys)} affiliations in the cache..")
+    resolutions = {}
+    for start in range(0, len(keys), QUERY_CHUNK_SIZE):
+        chunk = keys[start:start + QUERY_CHUNK_SIZE]
+        placeholders = ", ".join("?" * len(chunk))
+        rows = connection.execute(
+            f"""SELECT affiliation, country, institution, grid_id FROM resolutions
+                WHERE config_version = ? AND affiliation IN ({placeholders})""",
+            [version, *chunk],
+        )
+        for affiliation, country, institution, grid_id in rows:
+            resolutions[affiliation] = (country, institution, grid_id)
+    logger.info(f"Found {len(resolutions)} cached affiliations.")
+    return resolutions
+
+def store_resolutions(connection: sqlite3.Connection, version: str, resolutions: dict, logger: logging.Logger) -> None:
+    """Saves {key: (country, institution, grid_id)} under this config version"""
+    logger.info(f"Caching {len(resolutions)} resolved affiliations..")
+    connection.executemany(
+        """INSERT OR REPLACE INTO resolutions (config_version, affiliation, country, institution, grid_id)
+           VALUES (?, ?, ?, ?, ?)""",
+        [(version, key, *resolution) for key, resolution in resolutions.items()],
+    )
+    connection.commit()
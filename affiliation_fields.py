@@ -0,0 +1,68 @@
+"""Extracts emails and postcodes from affiliation strings, and initials from
+author names, with patterns compiled once at import"""
+
+import re
+import numpy as np
+import pandas as pd
+
+# Every pattern starts at a word boundary, which the combined pattern checks
+# once before trying the alternatives
+EMAIL = r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b'
+UK_POSTCODE = r'[A-Z]{1,2}\d{1,2}\s?\d[A-Z]{2}\b'
+US_POSTCODE = r'\d{5}(?:-\d{4})?\b'
+CANADIAN_POSTCODE = r'[A-Z]\d[A-Z]\s?\d[A-Z]\d\b'
+INITIALS = re.compile(r'\b\w*([A-Z])\w*\b')
+
+# Postcode kinds in order of priority: only the postcodes of the first kind
+# found in an affiliation are kept
+POSTCODE_KINDS = ("uk", "us", "ca")
+# Every field in one alternation of named groups, so an affiliation is
+# scanned once. An email's digits are never also taken for a postcode.
+FIELDS = re.compile(rf"\b(?:(?P<email>{EMAIL})|(?P<uk>{UK_POSTCODE})|(?P<us>{US_POSTCODE})|(?P<ca>{CANADIAN_POSTCODE}))")
+
+
+def join_found(found: list[str]) -> str | None:
+    """Joins the values found, comma separated, or None if there are none"""
+    return ", ".join(found) or None
+
+def extract_fields(text: str) -> tuple[str | None, str | None]:
+    """Extracts the (email, postcode) of an affiliation in one scan. Every
+    email is kept, and the postcodes of the first kind (UK, US, then
+    Canadian) present, each comma separated, or None.
+    e.g. 'Oxford OX3 9DU, UK. a@ox.ac.uk' -> ('a@ox.ac.uk', 'OX3 9DU')"""
+    found = {"email": [], "uk": [], "us": [], "ca": []}
+    for match in FIELDS.finditer(text):
+        found[match.lastgroup].append(match.group())
+
+    postcode = next((join_found(found[kind]) for kind in POSTCODE_KINDS if found[kind]), None)
+    return join_found(found["email"]), postcode
+
+def extract_initials(name: str) -> str:
+    """Gets the initials of a name, one per capitalised word
+    e.g. 'John Quincy Smith' -> 'JQS'"""
+    return "".join(INITIALS.findall(name))
+
+def extract_fields_column(affiliations: pd.Series) -> pd.DataFrame:
+    """Column variant of extract_fields, for batch use. Each distinct
+    affiliation is scanned once by Series.str.extractall with the combined
+    pattern, and the results are mapped back onto the rows. Returns a frame
+    with 'email' and 'postcode' columns aligned with the input, None where
+    there are none."""
+    codes, uniques = pd.factorize(affiliations)
+    matches = pd.Series(uniques, dtype=object).str.extractall(FIELDS.pattern)
+
+    # Comma separated values of each kind, indexed by position in uniques
+    joined = {kind: matches[kind].dropna().groupby(level=0).agg(", ".join) for kind in ("email",) + POSTCODE_KINDS}
+    postcodes = joined["uk"].combine_first(joined["us"]).combine_first(joined["ca"])
+
+    # Missing affiliations have code -1, which takes the trailing None
+    emails = np.array(missing_as_none(joined["email"], len(uniques)) + [None], dtype=object)
+    postcodes = np.array(missing_as_none(postcodes, len(uniques)) + [None], dtype=object)
+    return pd.DataFrame({"email": emails.take(codes), "postcode": postcodes.take(codes)},
+                        index=affiliations.index, dtype=object)
+
+def missing_as_none(values: pd.Series, length: int) -> list:
+    """Lists values indexed 0..length-1, with positions not present as None"""
+    values = values.reindex(range(length)).to_numpy(dtype=object)
+    values[pd.isna(values)] = None
+    return values.tolist()
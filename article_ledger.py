@@ -0,0 +1,91 @@
+"""Ledger of the PubMed articles already processed, keyed by PMID, so that
+incremental runs only extract and refine new or changed articles"""
+
+import sqlite3
+import hashlib
+import logging
+import xml.etree.ElementTree as ET
+
+
+def open_ledger(file_path: str, logger: logging.Logger) -> sqlite3.Connection:
+    """Opens (creating if needed) the sqlite article ledger. Articles are
+    'pending' once extracted, and 'processed' once their refined rows
+    have been saved."""
+    logger.info(f"Opening article ledger {file_path}..")
+    connection = sqlite3.connect(file_path, timeout=60)
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS processed (
+               pmid TEXT PRIMARY KEY,
+               content_hash TEXT NOT NULL
+           )"""
+    )
+    connection.execute(
+        """CREATE TABLE IF NOT EXISTS pending (
+               pmid TEXT PRIMARY KEY,
+               content_hash TEXT NOT NULL
+           )"""
+    )
+    connection.commit()
+    return connection
+
+def article_fingerprint(article: ET.Element) -> tuple[str, str]:
+    """Returns an article's PMID and a hash of its content. The whitespace
+    after the closing tag is not content, so is left out of the hash."""
+    pmid = article.findtext("MedlineCitation/PMID") or article.findtext(".//PMID")
+    tail, article.tail = article.tail, None
+    content_hash = hashlib.sha256(ET.tostring(article)).hexdigest()
+    article.tail = tail
+    return pmid, content_hash
+
+def reset_pending(connection: sqlite3.Connection, logger: logging.Logger) -> None:
+    """Forgets articles left pending by a run that did not finish"""
+    logger.info("Clearing pending articles from the ledger..")
+    connection.execute("DELETE FROM pending")
+    connection.commit()
+
+def filter_new_articles(articles, connection: sqlite3.Connection, logger: logging.Logger, pending: list = None):
+    """Yields only the articles whose PMID is new, or whose content has
+    changed since it was processed, marking each one as pending.
+    If a pending list is given, each one's (pmid, content_hash) is appended
+    to it instead, and the ledger is only read. Worker processes do this,
+    so none holds the ledger's write lock while the others wait on it, and
+    the pairs are marked pending with mark_pending."""
+    logger.info("Skipping articles already in the ledger..")
+    new_count = 0
+    skipped_count = 0
+
+    for article in articles:
+        pmid, content_hash = article_fingerprint(article)
+        processed = connection.execute("SELECT content_hash FROM processed WHERE pmid = ?", (pmid,)).fetchone()
+        if processed is not None and processed[0] == content_hash:
+            skipped_count += 1
+            continue
+
+        if pending is None:
+            connection.execute("INSERT OR REPLACE INTO pending VALUES (?, ?)", (pmid, content_hash))
+        else:
+            pending.append((pmid, content_hash))
+        new_count += 1
+        yield article
+
+    connection.commit()
+    logger.info(f"{new_count} new or changed articles, {skipped_count} unchanged articles skipped.")
+
+def mark_pending(connection: sqlite3.Connection, pending: list[tuple[str, str]], logger: logging.Logger) -> None:
+    """Marks (pmid, content_hash) pairs as pending, in one transaction"""
+    logger.info(f"Marking {len(pending)} articles as pending..")
+    connection.executemany("INSERT OR REPLACE INTO pending VALUES (?, ?)", pending)
+    connection.commit()
+
+def pending_pmids(connection: sqlite3.Connection) -> list[str]:
+    """Returns the PMIDs of every pending article"""
+    return [pmid for (pmid,) in connection.execute("SELECT pmid FROM pending")]
+
+def commit_pending(connection: sqlite3.Connection, logger: logging.Logger) -> int:
+    """Marks every pending article as processed, returns how many there were"""
+    pending_count = connection.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+    logger.info(f"Marking {pending_count} pending articles as processed..")
+    connection.execute("INSERT OR REPLACE INTO processed SELECT pmid, content_hash FROM pending")
+    connection.execute("DELETE FROM pending")
+    connection.commit()
+    return pending_count
@@ -0,0 +1,66 @@
+"""Compact records of extracted articles and their authorships. Article
+fields are held once per PMID rather than copied into every author row,
+and the strings repeated across articles are interned so each is held once.
+The two are only joined into one row per author/affiliation when needed."""
+
+import sys
+import pandas as pd
+
+# Article fields, in the order they appear in joined rows
+ARTICLE_FIELDS = (
+    "journal", "iso_abbreviation", "year", "pmid", "doi", "abstract", "key_words", "mesh_descriptors",
+    "country", "medline_ta", "nlm_unique_id", "issn_linking", "formatted_date",
+)
+# Authorship fields besides the PMID, in the order they appear in joined rows
+AUTHORSHIP_FIELDS = ("name", "initials", "affiliation", "email", "postcode")
+# Columns of a joined row, one per author/affiliation pair
+JOINED_COLUMNS = AUTHORSHIP_FIELDS + ARTICLE_FIELDS
+
+
+def intern_text(value: str | None) -> str | None:
+    """Interns a string, so equal strings share one object. None is passed through."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Article:
+    """The fields of one PubMed article, keyed by PMID"""
+    __slots__ = ARTICLE_FIELDS
+
+    def __init__(self, pmid: str, journal: str = None, iso_abbreviation: str = None, year: str = None, doi: str = None,
+                 abstract: str = None, key_words: list[str] = (), mesh_descriptors: list[str] = (), country: str = None,
+                 medline_ta: str = None, nlm_unique_id: str = None, issn_linking: str = None, formatted_date: any = None):
+        self.pmid = intern_text(pmid)
+        self.journal = intern_text(journal)
+        self.iso_abbreviation = intern_text(iso_abbreviation)
+        self.year = intern_text(year)
+        self.doi = doi
+        self.abstract = abstract
+        self.key_words = [intern_text(key_word) for key_word in key_words]
+        self.mesh_descriptors = [intern_text(descriptor) for descriptor in mesh_descriptors]
+        self.country = intern_text(country)
+        self.medline_ta = intern_text(medline_ta)
+        self.nlm_unique_id = intern_text(nlm_unique_id)
+        self.issn_linking = intern_text(issn_linking)
+        self.formatted_date = formatted_date
+
+
+class Authorship:
+    """One author/affiliation pair of an article"""
+    __slots__ = ("pmid",) + AUTHORSHIP_FIELDS
+
+    def __init__(self, pmid: str, name: str, initials: str, affiliation: str, email: str = None, postcode: str = None):
+        self.pmid = intern_text(pmid)
+        self.name = intern_text(name)
+        self.initials = intern_text(initials)
+        self.affiliation = intern_text(affiliation)
+        self.email = intern_text(email)
+        self.postcode = intern_text(postcode)
+
+
+def join_tables(articles: pd.DataFrame, authorships: pd.DataFrame) -> pd.DataFrame:
+    """Joins the articles table to the authorships table on PMID, one row per
+    author/affiliation pair in authorship order. If an article was extracted
+    more than once, its last version is joined."""
+    articles = articles.drop_duplicates("pmid", keep="last")
+    joined = authorships.merge(articles, on="pmid", how="left", sort=False)
+    return joined[list(JOINED_COLUMNS)]
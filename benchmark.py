@@ -0,0 +1,430 @@
+"""Benchmarks each stage of the pipeline against a synthetic PubMed corpus
+and synthetic GRID reference data, and records the timings as JSON"""
+
+"""
+The corpus is generated at a configurable scale, so results are repeatable
+and can be compared run-to-run offline. Each stage is timed on its own:
+the import merge, extraction, parquet I/O, email and postcode extraction,
+NER, building and opening the match indexes, country matching,
+institution matching (also of typo'd names, checked against the unindexed
+search) and resolving both through the GRID index.
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import argparse
+import platform
+import statistics
+import string
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+import pandas as pd
+import config as c
+import metrics
+import parquet_io
+import article_records
+import import_data
+import extract_from_xml as extract
+import refine_data as refine
+import match_index
+import grid_index
+import affiliation_fields
+
+LOG_DIR = c.LOG_DIR
+BENCHMARK_RESULTS = c.BENCHMARK_RESULTS
+SPACEY_DATASET = c.SPACEY_DATASET
+SPACEY_DISABLED = c.SPACEY_DISABLED
+SPACEY_BATCH_SIZE = c.SPACEY_BATCH_SIZE
+SPACEY_N_PROCESS = c.SPACEY_N_PROCESS
+FUZZY_THRESHOLD_LENIENT = c.FUZZY_THRESHOLD_LENIENT
+EXTRACT_BATCH_SIZE = c.EXTRACT_BATCH_SIZE
+
+SCRIPT_NAME = (os.path.basename(__file__)).split(".")[0]
+LOGGING_LEVEL = c.module_log_level(SCRIPT_NAME)
+
+# Building blocks of the synthetic affiliations. Cities are paired with the
+# country they are in, so every affiliation has a known country.
+CITIES = [
+    ("Oxford", "United Kingdom", "OX3 9DU"), ("Manchester", "United Kingdom", "M13 9PL"),
+    ("Edinburgh", "United Kingdom", "EH8 9YL"), ("Boston", "United States", "02115"),
+    ("Baltimore", "United States", "21205"), ("Seattle", "United States", "98195"),
+    ("Toronto", "Canada", "M5S 1A8"), ("Montreal", "Canada", "H3A 0G4"),
+    ("Stockholm", "Sweden", None), ("Uppsala", "Sweden", None),
+    ("Berlin", "Germany", None), ("Munich", "Germany", None),
+    ("Paris", "France", None), ("Lyon", "France", None),
+    ("Beijing", "China", None), ("Shanghai", "China", None),
+    ("Tokyo", "Japan", None), ("Osaka", "Japan", None),
+    ("Sydney", "Australia", None), ("Melbourne", "Australia", None),
+]
+INSTITUTION_FORMS = [
+    "University of {city}", "{city} University", "{city} Institute of Technology",
+    "{city} General Hospital", "{city} Medical Centre", "{city} Children's Hospital",
+    "Royal {city} Infirmary", "{city} Cancer Research Institute",
+]
+DEPARTMENTS = [
+    "Department of Medicine", "Department of Rheumatology", "Division of Immunology",
+    "School of Public Health", "Department of Ophthalmology", "Centre for Oral Health",
+]
+FIRST_NAMES = ["John", "Mary", "Wei", "Aiko", "Lars", "Sofia", "Ahmed", "Chloe", "Ravi", "Elena"]
+LAST_NAMES = ["Smith", "Jones", "Zhang", "Tanaka", "Andersson", "Garcia", "Khan", "Martin", "Patel", "Rossi"]
+# Number of institution names typo'd to time and check fuzzy matching
+TYPO_SAMPLES = 300
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+
+def generate_affiliations(diversity: int, rng: random.Random) -> list[dict]:
+    """Generates diversity distinct affiliations, each with the institution,
+    city and country it names, e.g.
+    {'affiliation': 'Department of Medicine, University of Oxford, Oxford OX3 9DU, United Kingdom.',
+     'institution': 'University of Oxford', 'city': 'Oxford', 'country': 'United Kingdom'}"""
+    affiliations = []
+    seen = set()
+    while len(affiliations) < diversity:
+        city, country, postcode = rng.choice(CITIES)
+        institution = rng.choice(INSTITUTION_FORMS).format(city=city)
+        department = rng.choice(DEPARTMENTS)
+        location = f"{city} {postcode}" if postcode and rng.random() < 0.7 else city
+        text = f"{department}, {institution}, {location}, {country}."
+        if rng.random() < 0.3:
+            text += f" {rng.choice(FIRST_NAMES).lower()}.{rng.choice(LAST_NAMES).lower()}@example.org"
+        if text in seen:
+            # Few enough combinations are left that a suffix keeps them distinct
+            text = f"{text} Unit {len(affiliations)}."
+        seen.add(text)
+        affiliations.append({"affiliation": text, "institution": institution, "city": city, "country": country})
+    return affiliations
+
+def article_xml(pmid: int, authors_per_article: int, affiliations: list[dict], rng: random.Random) -> str:
+    """Builds one synthetic PubmedArticle, shaped like the real ones the
+    extractor reads. Authors get between 0 and 2 affiliations."""
+    year = rng.randint(2000, 2024)
+    authors = []
+    for _ in range(rng.randint(max(authors_per_article - 2, 0), authors_per_article + 2)):
+        author_affiliations = "".join(
+            f"<AffiliationInfo><Affiliation>{escape(rng.choice(affiliations)['affiliation'])}</Affiliation></AffiliationInfo>"
+            for _ in range(rng.choice((0, 1, 1, 1, 2))))
+        first_name = rng.choice(FIRST_NAMES)
+        authors.append(f"<Author ValidYN=\"Y\"><LastName>{rng.choice(LAST_NAMES)}</LastName>"
+                       f"<ForeName>{first_name} {rng.choice('ABCDEFGH')}</ForeName><Initials>{first_name[0]}</Initials>"
+                       f"{author_affiliations}</Author>")
+    keywords = "".join(f"<Keyword MajorTopicYN=\"N\">keyword {rng.randint(1, 500)}</Keyword>" for _ in range(rng.randint(0, 5)))
+    mesh = "".join(f"<MeshHeading><DescriptorName UI=\"D{rng.randint(1, 99999):06d}\" MajorTopicYN=\"N\">Descriptor {rng.randint(1, 300)}</DescriptorName></MeshHeading>"
+                   for _ in range(rng.randint(0, 6)))
+    return (
+        f"<PubmedArticle><MedlineCitation Status=\"MEDLINE\" Owner=\"NLM\"><PMID Version=\"1\">{pmid}</PMID>"
+        f"<Article PubModel=\"Print\"><Journal><ISSN IssnType=\"Electronic\">1234-5678</ISSN><JournalIssue CitedMedium=\"Internet\">"
+        f"<Volume>{rng.randint(1, 80)}</Volume><PubDate><Year>{year}</Year><Month>{rng.choice(MONTHS)}</Month><Day>{rng.randint(1, 28)}</Day></PubDate>"
+        f"</JournalIssue><Title>Journal of Synthetic Research {pmid % 40}</Title><ISOAbbreviation>J Synth Res</ISOAbbreviation></Journal>"
+        f"<ArticleTitle>Synthetic article {pmid}</ArticleTitle>"
+        f"<ELocationID EIdType=\"doi\" ValidYN=\"Y\">10.0000/synthetic.{pmid}</ELocationID>"
+        f"<Abstract><AbstractText Label=\"BACKGROUND\">Background of article {pmid}.</AbstractText>"
+        f"<AbstractText Label=\"RESULTS\">Results of article {pmid}.</AbstractText></Abstract>"
+        f"<AuthorList CompleteYN=\"Y\">{''.join(authors)}</AuthorList></Article>"
+        f"<MedlineJournalInfo><Country>England</Country><MedlineTA>J Synth Res</MedlineTA>"
+        f"<NlmUniqueID>{100000 + pmid % 40}</NlmUniqueID><ISSNLinking>1234-5678</ISSNLinking></MedlineJournalInfo>"
+        f"<MeshHeadingList>{mesh}</MeshHeadingList><KeywordList Owner=\"NOTNLM\">{keywords}</KeywordList>"
+        f"</MedlineCitation></PubmedArticle>\n"
+    )
+
+def generate_pubmed_files(directory: str, files: int, articles: int, authors_per_article: int,
+                          affiliations: list[dict], rng: random.Random) -> list[str]:
+    """Writes articles spread over several PubmedArticleSet files, as they
+    are stored in S3, each with its own prolog and DOCTYPE. Returns their
+    names in order."""
+    names = []
+    pmid = 1
+    per_file = -(-articles // files)
+    for index in range(files):
+        name = f"synthetic/pubmed_{index:04d}.xml"
+        os.makedirs(os.path.dirname(f"{directory}/{name}"), exist_ok=True)
+        with open(f"{directory}/{name}", "w", encoding="utf-8") as file:
+            file.write('<?xml version="1.0" ?>\n<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2024//EN" '
+                       '"https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n<PubmedArticleSet>\n')
+            for _ in range(min(per_file, articles - pmid + 1)):
+                file.write(article_xml(pmid, authors_per_article, affiliations, rng))
+                pmid += 1
+            file.write("</PubmedArticleSet>\n")
+        names.append(name)
+    return names
+
+def generate_grid_csvs(aliases_path: str, addresses_path: str, affiliations: list[dict], aliases: int, rng: random.Random) -> None:
+    """Writes GRID style aliases.csv (grid_id, alias) and addresses.csv
+    (grid_id, city, country). Every institution named by an affiliation is
+    included, padded with made up institutions to aliases rows."""
+    institutions = {affiliation["institution"]: affiliation for affiliation in affiliations}
+    padding = 0
+    while len(institutions) < aliases:
+        city, country, _ = rng.choice(CITIES)
+        padding += 1
+        name = f"{rng.choice(INSTITUTION_FORMS).format(city=city)} Annex {padding}"
+        institutions[name] = {"institution": name, "city": city, "country": country}
+
+    rows = [{"grid_id": f"grid.{position}.{position % 10}", "alias": name, "city": details["city"], "country": details["country"]}
+            for position, (name, details) in enumerate(institutions.items(), start=1)]
+    grid = pd.DataFrame(rows)
+    grid[["grid_id", "alias"]].to_csv(aliases_path, index=False)
+    grid[["grid_id", "city", "country"]].to_csv(addresses_path, index=False)
+
+
+def add_typos(text: str, rng: random.Random) -> str:
+    """Inserts, deletes or replaces one to three letters of a string, e.g.
+    'University of Oxford' -> 'Universty of Oxfored'"""
+    letters = list(text)
+    for _ in range(rng.randint(1, 3)):
+        position = rng.randrange(len(letters))
+        edit = rng.random()
+        if edit < 0.4:
+            letters.insert(position, rng.choice(string.ascii_lowercase))
+        elif edit < 0.7 and len(letters) > 1:
+            del letters[position]
+        else:
+            letters[position] = rng.choice(string.ascii_lowercase)
+    return "".join(letters)
+
+
+class LocalObjectStore:
+    """Serves files in a directory through the part of the boto3 S3 client
+    the import uses, so the merge can be timed without the network"""
+
+    class Body:
+        def __init__(self, file_path: str):
+            self.file_path = file_path
+
+        def iter_chunks(self, chunk_size: int):
+            with open(self.file_path, "rb") as file:
+                while chunk := file.read(chunk_size):
+                    yield chunk
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def get_object(self, Bucket: str, Key: str) -> dict:
+        return {"Body": self.Body(f"{self.directory}/{Key}")}
+
+
+def extract_countries_set(addresses_df: pd.DataFrame, logger: logging.Logger) -> set:
+    """Extracts countries to a set"""
+    logger.info("Building countries set..")
+
+    try:
+        countries = set(addresses_df['country'])
+        logger.info("Countries extracted.")
+        return countries
+    except Exception as e:
+        logger.debug("Error extracting countries.")
+        logger.debug(e)
+
+def extract_institutions_set(aliases_df: pd.DataFrame, logger: logging.Logger) -> set:
+    """Extracts institution names to a set"""
+    logger.info("Building institutions set..")
+    try:
+        institutions = set(aliases_df['alias'])
+        logger.info("Institutions extracted.")
+        return institutions
+    except Exception as e:
+        logger.debug("Error extracting institutions.")
+        logger.debug(e)
+
+def timed(stage: str, repeat: int, func, items: int = None) -> tuple[dict, any]:
+    """Runs func repeat times, returning the fastest and median times, and
+    the throughput of the fastest if the number of items is known"""
+    times = []
+    result = None
+    for _ in range(repeat):
+        with metrics.span(f"benchmark.{stage}") as span:
+            result = func()
+        times.append(span.duration)
+
+    timing = {"seconds_min": min(times), "seconds_median": statistics.median(times), "repeats": repeat}
+    if items is not None:
+        timing["items"] = items
+        timing["items_per_second"] = items / min(times) if min(times) > 0 else None
+    return timing, result
+
+def git_commit() -> str | None:
+    """Returns the commit the benchmark ran against, if in a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(work_dir: str, articles: int, authors_per_article: int, diversity: int, aliases: int,
+                   files: int, workers: int, repeat: int, seed: int, skip_ner: bool, logger: logging.Logger) -> dict:
+    """Generates the synthetic data in work_dir, then times each stage"""
+    rng = random.Random(seed)
+    results = {}
+
+    logger.info("---> Generating synthetic corpus..")
+    affiliations = generate_affiliations(diversity, rng)
+    objects_dir = f"{work_dir}/objects"
+    keys = generate_pubmed_files(objects_dir, files, articles, authors_per_article, affiliations, rng)
+    aliases_path, addresses_path = f"{work_dir}/aliases.csv", f"{work_dir}/addresses.csv"
+    generate_grid_csvs(aliases_path, addresses_path, affiliations, aliases, rng)
+    merged_path = f"{work_dir}/merged.xml"
+    articles_path, authorships_path = f"{work_dir}/articles.parquet", f"{work_dir}/authorships.parquet"
+    object_bytes = sum(os.path.getsize(f"{objects_dir}/{key}") for key in keys)
+
+    logger.info("---> Timing the import merge..")
+    store = LocalObjectStore(objects_dir)
+    results["import_merge"], _ = timed("import_merge", repeat, lambda: import_data.download_and_merge_xml_files(
+        store, "synthetic", keys, merged_path, logger), items=object_bytes)
+
+    logger.info("---> Timing extraction..")
+    if workers > 1:
+        results["extraction"], _ = timed("extraction", repeat, lambda: extract.parallel_extract(
+            merged_path, articles_path, authorships_path, workers, logger), items=articles)
+        records = list(extract.iter_article_records(merged_path, logger))
+    else:
+        results["extraction"], records = timed("extraction", repeat, lambda: list(extract.iter_article_records(merged_path, logger)),
+                                               items=articles)
+    row_count = sum(len(authorships) for _, authorships in records)
+    results["extraction"]["rows"] = row_count
+
+    logger.info("---> Timing parquet I/O..")
+    results["parquet_write"], _ = timed("parquet_write", repeat, lambda: parquet_io.write_article_batches(
+        iter(records), articles_path, authorships_path, EXTRACT_BATCH_SIZE, logger), items=row_count)
+    results["parquet_write"]["bytes"] = os.path.getsize(articles_path) + os.path.getsize(authorships_path)
+    results["parquet_read"], df = timed("parquet_read", repeat, lambda: article_records.join_tables(
+        parquet_io.read_dataframe(articles_path), parquet_io.read_dataframe(authorships_path)), items=row_count)
+
+    logger.info("---> Timing email and postcode extraction..")
+    results["affiliation_fields"], _ = timed("affiliation_fields", repeat, lambda: affiliation_fields.extract_fields_column(
+        df["affiliation"]), items=len(df))
+
+    unique_affiliations = [affiliation for affiliation in pd.unique(df["affiliation"]) if isinstance(affiliation, str)]
+    truth = {affiliation["affiliation"]: affiliation for affiliation in affiliations}
+
+    logger.info("---> Timing NER..")
+    entities = None
+    if not skip_ner:
+        try:
+            nlp = refine.load_nlp(SPACEY_DATASET, SPACEY_DISABLED, logger)
+            results["ner"], entities = timed("ner", repeat, lambda: refine.extract_entities(
+                unique_affiliations, nlp, SPACEY_BATCH_SIZE, SPACEY_N_PROCESS, logger), items=len(unique_affiliations))
+        except (ImportError, OSError) as e:
+            logger.warning(f"Skipping NER, spacey model {SPACEY_DATASET} could not be loaded: {e}")
+    if entities is None:
+        # Without NER, match the entities the generator knows each affiliation names
+        entities = {affiliation: {"GPE": {truth[affiliation]["city"], truth[affiliation]["country"]},
+                                  "ORG": {truth[affiliation]["institution"]}}
+                    for affiliation in unique_affiliations}
+
+    countries = extract_countries_set(pd.read_csv(addresses_path), logger)
+    institutions = extract_institutions_set(pd.read_csv(aliases_path), logger)
+    results["index_build"], (country_index, institution_index) = timed("index_build", repeat, lambda: (
+        match_index.build_match_index(countries, logger), match_index.build_match_index(institutions, logger)),
+        items=len(countries) + len(institutions))
+
+    # The generated GRID data has no institutes.csv, so aliases stand as names
+    index_dir = f"{work_dir}/grid_index"
+    institutes_path = f"{work_dir}/institutes.csv"
+    grid_index.build_grid_index(aliases_path, addresses_path, institutes_path, index_dir, logger)
+    results["grid_index_load"], grid = timed("grid_index_load", repeat, lambda: grid_index.load_grid_index(
+        logger, aliases_path, addresses_path, institutes_path, index_dir), items=len(countries) + len(institutions))
+    details = refine.institution_details(grid, logger)
+
+    logger.info("---> Timing country matching..")
+    results["country_matching"], matched_countries = timed("country_matching", repeat, lambda: [
+        refine.identify_matching_country(affiliation, country_index, FUZZY_THRESHOLD_LENIENT, None, logger, entities[affiliation])
+        for affiliation in unique_affiliations], items=len(unique_affiliations))
+    results["country_matching"]["accuracy"] = sum(
+        match == truth[affiliation]["country"] for affiliation, match in zip(unique_affiliations, matched_countries)) / max(len(unique_affiliations), 1)
+
+    logger.info("---> Timing institution matching..")
+    results["institution_matching"], matched_institutions = timed("institution_matching", repeat, lambda: [
+        refine.identify_matching_institution(affiliation, institution_index, FUZZY_THRESHOLD_LENIENT, None, logger, entities[affiliation])
+        for affiliation in unique_affiliations], items=len(unique_affiliations))
+    results["institution_matching"]["accuracy"] = sum(
+        match == truth[affiliation]["institution"] for affiliation, match in zip(unique_affiliations, matched_institutions)) / max(len(unique_affiliations), 1)
+
+    # Typo'd names fall through the exact match to fuzzy scoring. The index
+    # must find a match whenever the unindexed search does.
+    logger.info("---> Timing typo'd institution matching..")
+    typos = [add_typos(name, rng) for name in rng.sample(sorted(institutions), min(TYPO_SAMPLES, len(institutions)))]
+    results["typo_matching"], indexed_matches = timed("typo_matching", repeat, lambda: [
+        match_index.fuzzy_match_indexed(typo, institution_index, FUZZY_THRESHOLD_LENIENT, logger) for typo in typos], items=len(typos))
+    unindexed_matches = [refine.fuzzy_match(typo, institutions, FUZZY_THRESHOLD_LENIENT, logger) or "Unknown" for typo in typos]
+    missed = sum(indexed == "Unknown" != unindexed for indexed, unindexed in zip(indexed_matches, unindexed_matches))
+    results["typo_matching"]["missed_by_index"] = missed
+    if missed:
+        logger.warning(f"The match index missed {missed} matches the unindexed search found.")
+
+    logger.info("---> Timing affiliation resolution..")
+    results["affiliation_resolution"], resolved = timed("affiliation_resolution", repeat, lambda: [
+        refine.resolve_affiliation(affiliation, grid["country_index"], grid["institution_index"], FUZZY_THRESHOLD_LENIENT, None,
+                                   logger, entities[affiliation], details)
+        for affiliation in unique_affiliations], items=len(unique_affiliations))
+    results["affiliation_resolution"]["accuracy"] = sum(
+        (country, institution) == (truth[affiliation]["country"], truth[affiliation]["institution"])
+        for affiliation, (country, institution, _) in zip(unique_affiliations, resolved)) / max(len(unique_affiliations), 1)
+
+    return results
+
+def save_results(record: dict, file_path: str, logger: logging.Logger) -> None:
+    """Appends one benchmark run to the results file, one JSON object a line"""
+    logger.info(f"Saving benchmark results to {file_path}..")
+    with open(file_path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+def main(articles: int = 1000, authors_per_article: int = 4, diversity: int = 200, aliases: int = 5000, files: int = 8,
+         workers: int = 1, repeat: int = 3, seed: int = 0, skip_ner: bool = False,
+         output: str = f"{LOG_DIR}/{BENCHMARK_RESULTS}", keep: bool = False) -> dict:
+    """Runs the benchmark suite and records the results"""
+
+    logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}", LOGGING_LEVEL)
+    logger.info("---> Logging initiated..")
+
+    params = {"articles": articles, "authors_per_article": authors_per_article, "affiliation_diversity": diversity,
+              "aliases": aliases, "files": files, "workers": workers, "repeat": repeat, "seed": seed}
+    logger.info(f"---> Benchmarking with {params}..")
+
+    work_dir = tempfile.mkdtemp(prefix="pubmed_benchmark_")
+    try:
+        results = run_benchmarks(work_dir, articles, authors_per_article, diversity, aliases, files,
+                                 workers, repeat, seed, skip_ner, logger)
+    finally:
+        if keep:
+            logger.info(f"---> Synthetic data kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    record = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }
+    save_results(record, output, logger)
+
+    for stage, timing in results.items():
+        throughput = f", {timing['items_per_second']:.1f} items/s" if timing.get("items_per_second") else ""
+        logger.info(f"{stage}: {timing['seconds_min']:.4f}s{throughput}")
+    return record
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument("--articles", type=int, default=1000, help="Number of synthetic articles")
+    parser.add_argument("--authors", type=int, default=4, help="Average number of authors per article")
+    parser.add_argument("--affiliations", type=int, default=200, help="Number of distinct affiliations")
+    parser.add_argument("--aliases", type=int, default=5000, help="Number of GRID institution aliases")
+    parser.add_argument("--files", type=int, default=8, help="Number of XML files the articles are split over")
+    parser.add_argument("--workers", type=int, default=1, help="Number of extraction processes")
+    parser.add_argument("--repeat", type=int, default=3, help="Times each stage is run, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data")
+    parser.add_argument("--skip-ner", action="store_true", help="Don't load spacey, match the known entities instead")
+    parser.add_argument("--output", default=f"{LOG_DIR}/{BENCHMARK_RESULTS}", help="JSON lines file the results are appended to")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic data after the run")
+    args = parser.parse_args()
+
+    main(args.articles, args.authors, args.affiliations, args.aliases, args.files, args.workers,
+         args.repeat, args.seed, args.skip_ner, args.output, args.keep)
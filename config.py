@@ -1,65 +1,224 @@
 """Config files"""
 import os
+import sys
+import queue
+import atexit
 import logging
 import cProfile
 import pstats
+import subprocess
 from io import StringIO
+from logging.handlers import QueueHandler, QueueListener
 
 # dir where data is stored
 DATA_DIR = "data"
 # dir where logs are stored
 LOG_DIR = "logs"
 
+# AWS region of the bucket the raw PubMed XML files are imported from,
+# the bucket itself is set by the S3_BUCKET environment variable
+AWS_REGION = "eu-west-2"
+# Number of S3 objects downloaded at once
+S3_DOWNLOAD_WORKERS = 8
+# Bytes read from an S3 object body at a time
+S3_CHUNK_SIZE = 1024 * 1024
+# Only objects under this key prefix are listed, filtered server side
+IMPORT_PREFIX = ""
+# Only xml objects whose keys contain this string are imported
+IMPORT_KEY_FILTER = "joshua"
+# Record of the S3 objects already imported, for incremental runs
+S3_MANIFEST = "s3_manifest.json"
+# Objects imported by the last run, added to the manifest only once the
+# articles they hold have been refined
+S3_MANIFEST_PENDING = "s3_manifest.pending.json"
+
 # Raw pubmed data files in xml format
 PUBMED_FILE = "pubmed_result_sjogren.xml"
-# Extracted PubMed Files
-EXTRACTED_DATA = "extracted_data.parquet"
-# Data that has been refined, with more attributes extracted
-REFINED_DATA = "refined_data.parquet"
+# Parse the PubMed XML incrementally, one article at a time, instead of
+# loading the whole document into memory
+STREAM_XML = True
+# Number of bytes read from the PubMed XML per parser feed
+XML_CHUNK_SIZE = 1024 * 1024
+# Number of extracted articles written per parquet row group
+EXTRACT_BATCH_SIZE = 10000
+# Number of processes used to extract articles, 1 extracts serially
+EXTRACT_WORKERS = 1
+# Shards handed to each extraction process, more shards balance load better
+SHARDS_PER_WORKER = 4
+# Compression codec and level of every parquet file written
+PARQUET_COMPRESSION = "zstd"
+PARQUET_COMPRESSION_LEVEL = 6
+# Max number of rows per row group of parquet files written in one go
+PARQUET_ROW_GROUP_SIZE = 100000
+# Extracted PubMed files: the articles, one row per PMID, and their
+# authorships, one row per author/affiliation pair
+EXTRACTED_ARTICLES = "extracted_articles.parquet"
+EXTRACTED_AUTHORSHIPS = "extracted_authorships.parquet"
+# Data that has been refined, with more attributes extracted. A parquet
+# dataset directory, hive partitioned by the REFINED_PARTITIONS columns
+REFINED_DATA = "refined_data"
+REFINED_PARTITIONS = ("year", "country")
+# JSON summary of the refined data's quality, saved in the logs dir
+QUALITY_REPORT = "quality_report.json"
+# Number of most common values listed per column in the quality report
+QUALITY_TOP_VALUES = 5
+# Sqlite ledger of the articles already processed, for incremental runs
+ARTICLE_LEDGER = "article_ledger.sqlite"
+# Record of the pipeline stages completed and their input/output fingerprints
+PIPELINE_STATE = "pipeline_state.json"
+# Number of independent pipeline stages run at once
+PIPELINE_WORKERS = 2
+# Number of items (XML chunks or row batches) each queue between streaming
+# pipeline stages holds, bounds the memory used by a streaming run
+STREAM_QUEUE_SIZE = 8
 # GRID data
 ADDRESSES = "addresses.csv"
 ALIASES = "aliases.csv"
+# Versioned, memory mappable index compiled from the GRID data, see grid_index.py
+GRID_INDEX = "grid_index"
 INSTITUTES = "institutes.csv"
 
 # Threshold for fuzzy searches to accept a string as a match
 FUZZY_THRESHOLD_STRICT = 92
 FUZZY_THRESHOLD_LENIENT = 80
 
+# Bump when the affiliation matching logic changes, so cached
+# resolutions from older versions are no longer used
+MATCHING_VERSION = 4
+# Sqlite cache of affiliations already resolved to a country and institution
+AFFILIATION_CACHE = "affiliation_cache.sqlite"
+
 # Dataset to use with spacey
 SPACEY_DATASET = "en_core_web_lg"
+# Spacey components not needed for named entity recognition
+SPACEY_DISABLED = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
+# Number of affiliations spacey processes per batch
+SPACEY_BATCH_SIZE = 256
+# Number of processes spacey uses, -1 uses every core
+SPACEY_N_PROCESS = 1
 
 # Set to false if system does not have limited memdory for faster
 # CSV to pandas conversion
 LOW_MEMORY = False
 
+# Logging level of each module's logger, modules not listed use DEFAULT_LOG_LEVEL.
+# Set a module to logging.DEBUG to trace it row by row.
+DEFAULT_LOG_LEVEL = logging.INFO
+LOG_LEVELS = {
+    "import_data": logging.INFO,
+    "extract_from_xml": logging.INFO,
+    "refine_data": logging.INFO,
+    "data_quality": logging.INFO,
+    "pipeline": logging.INFO,
+}
+# Run metrics (spans, counters, gauges, histograms) are appended here as JSON lines
+METRICS_FILE = "metrics.jsonl"
+# Record a cProfile profile of every run, also turned on by the --profile flags
+PROFILE_RUNS = False
+# Benchmark runs are appended here as JSON lines, in the logs dir
+BENCHMARK_RESULTS = "benchmark_results.jsonl"
+# Most DEBUG records let through from any one line of code per second, the
+# rest are dropped and counted. INFO and above are never rate limited.
+LOG_RATE_LIMIT = 10
+
 # Functions
 
-def setup_logging(log_name: str, logging_level=logging.DEBUG):
-    """setup logging"""
+class CallSiteRateLimit(logging.Filter):
+    """Lets through at most `limit` records a second from each call site
+    (file and line), so a debug line in a per-row loop can't flood the logs.
+    Records at or above exempt_level always pass, by default everything but
+    DEBUG, so progress and report lines are never lost. The first record let
+    through after some were dropped says how many."""
+
+    def __init__(self, limit: int, exempt_level: int = logging.INFO):
+        super().__init__()
+        self.limit = limit
+        self.exempt_level = exempt_level
+        self.sites = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.exempt_level:
+            return True
+
+        site = (record.pathname, record.lineno)
+        second = int(record.created)
+        window, passed, dropped = self.sites.get(site, (second, 0, 0))
+        if window != second:
+            window, passed = second, 0
+
+        if passed >= self.limit:
+            self.sites[site] = (window, passed, dropped + 1)
+            return False
+
+        if dropped:
+            record.msg = f"{record.getMessage()} [{dropped} similar messages dropped]"
+            record.args = None
+        self.sites[site] = (window, passed + 1, 0)
+        return True
+
+# Queue, handlers and listener of each logger set up by setup_logging
+_log_outputs = {}
+
+def module_log_level(log_name: str) -> int:
+    """Looks up a module's logging level in LOG_LEVELS, by its script name
+    e.g. 'logs/refine_data' -> LOG_LEVELS['refine_data']"""
+    module = os.path.basename(log_name).split(".")[0]
+    return LOG_LEVELS.get(module, DEFAULT_LOG_LEVEL)
+
+def setup_logging(log_name: str, logging_level: int = None):
+    """Sets up a logger that logs to the console, a log file and an errors
+    file. The logger only puts records on a queue, rate limited per call
+    site, and a background listener thread formats and writes them, so
+    logging never blocks on I/O. The level defaults to the module's level
+    in LOG_LEVELS."""
     logger = logging.getLogger(log_name)
-    logger.setLevel(logging_level)
+    logger.setLevel(module_log_level(log_name) if logging_level is None else logging_level)
 
-    console_handler = logging.StreamHandler()
-    file_handler = logging.FileHandler(f'{log_name}.log')
-    error_file_handler = logging.FileHandler(f'{log_name}_errors.log')
+    outputs = _log_outputs.get(log_name)
+    if outputs is None:
+        console_handler = logging.StreamHandler()
+        file_handler = logging.FileHandler(f'{log_name}.log')
+        error_file_handler = logging.FileHandler(f'{log_name}_errors.log')
 
-    console_handler.setLevel(logging.DEBUG)
-    file_handler.setLevel(logging.DEBUG)
-    error_file_handler.setLevel(logging.ERROR)
+        console_handler.setLevel(logging.DEBUG)
+        file_handler.setLevel(logging.DEBUG)
+        error_file_handler.setLevel(logging.ERROR)
 
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    console_handler.setFormatter(formatter)
-    file_handler.setFormatter(formatter)
-    error_file_handler.setFormatter(formatter)
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        console_handler.setFormatter(formatter)
+        file_handler.setFormatter(formatter)
+        error_file_handler.setFormatter(formatter)
 
-    if not logger.handlers:
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
-        logger.addHandler(error_file_handler)
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(CallSiteRateLimit(LOG_RATE_LIMIT))
+        logger.addHandler(queue_handler)
+
+        outputs = {"queue": log_queue, "handlers": (console_handler, file_handler, error_file_handler),
+                   "listener": None, "pid": None}
+        _log_outputs[log_name] = outputs
+
+    # Listener threads are not copied into forked worker processes, so each
+    # process starts its own
+    if outputs["listener"] is None or outputs["pid"] != os.getpid():
+        listener = QueueListener(outputs["queue"], *outputs["handlers"], respect_handler_level=True)
+        listener.start()
+        outputs["listener"] = listener
+        outputs["pid"] = os.getpid()
 
     return logger
 
+def stop_logging() -> None:
+    """Writes out every queued record and stops this process's listener
+    threads. setup_logging starts them again if needed."""
+    for outputs in _log_outputs.values():
+        if outputs["listener"] is not None and outputs["pid"] == os.getpid():
+            outputs["listener"].stop()
+            outputs["listener"] = None
+
+atexit.register(stop_logging)
+
 def setup_subtle_logging(log_name, logging_level=logging.DEBUG):
     """setup logging"""
     logger = logging.getLogger(log_name)
@@ -100,4 +259,34 @@ def stop_monitor(script_name: str, profiler: cProfile.Profile, logger) -> None:
     ps = pstats.Stats(profiler, stream=s).sort_stats('cumulative')
     ps.print_stats()
  
-    logger.info(s.getvalue())
\ No newline at end of file
+    logger.info(s.getvalue())
+
+def report_import_times(module_name: str, top: int = 15) -> str:
+    """Imports a module in a fresh interpreter with -X importtime and reports
+    its total import time, and the slowest of the modules it imports
+    directly, by cumulative time. Used by the --startup-profile flags."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    total = None
+    direct_imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        seconds = int(cumulative) / 1_000_000
+        if depth == 0 and name.strip() == module_name:
+            total = seconds
+        elif depth == 1:
+            direct_imports.append((seconds, name.strip()))
+
+    if total is None:
+        return f"Could not import {module_name}:\n{result.stderr[-2000:]}"
+
+    lines = [f"Importing {module_name} takes {total:.3f}s. Slowest direct imports:"]
+    for seconds, name in sorted(direct_imports, reverse=True)[:top]:
+        lines.append(f"  {seconds:8.3f}s  {name}")
+    return "\n".join(lines)
\ No newline at end of file
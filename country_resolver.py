@@ -0,0 +1,82 @@
+"""Resolves country candidates with a prebuilt pycountry hash index"""
+
+import logging
+
+# Common names that pycountry does not know, mapped to the value looked up
+# instead. e.g. 'UK' is looked up as 'GB'
+COUNTRY_ALIASES = {"UK": "GB"}
+
+_default_index = None
+
+
+def build_country_index(logger: logging.Logger) -> dict:
+    """Builds lowercased lookup tables for countries and subdivisions, so that
+    each candidate resolves with a couple of hash lookups instead of a scan
+    over every country.
+
+    Only countries that have an official name are indexed, by alpha-2,
+    alpha-3, name and official name, which is what pycountry_match has
+    always matched against. Subdivisions are indexed by every field that
+    pycountry.subdivisions.lookup compares against."""
+    import pycountry
+
+    logger.info("Building pycountry lookup index..")
+
+    countries = {}
+    for country in pycountry.countries:
+        if not hasattr(country, "official_name"):
+            continue
+        for value in (country.alpha_2, country.alpha_3, country.name, country.official_name):
+            countries.setdefault(value.lower(), country.name)
+
+    subdivisions = set()
+    for subdivision in pycountry.subdivisions:
+        for field in ("code", "country_code", "name", "parent_code", "type"):
+            value = getattr(subdivision, field, None)
+            if isinstance(value, str):
+                subdivisions.add(value.lower())
+
+    logger.info(f"Indexed {len(countries)} country keys and {len(subdivisions)} subdivision keys.")
+    return {"countries": countries, "subdivisions": subdivisions}
+
+def load_default_index(logger: logging.Logger) -> dict:
+    """Builds the shared country index on first use and returns it"""
+    global _default_index
+    if _default_index is None:
+        _default_index = build_country_index(logger)
+    return _default_index
+
+def is_subdivision(name: str, index: dict) -> bool:
+    """Checks if a name matches a subdivision of any country"""
+    return name.lower() in index["subdivisions"]
+
+def resolve_country(candidate: str, index: dict) -> str | None:
+    """Resolves one candidate string to a pycountry country name.
+    Candidates that are also subdivision names or codes are ignored,
+    e.g. 'MD' is Maryland as often as it is Moldova."""
+    candidate = COUNTRY_ALIASES.get(candidate, candidate)
+    if is_subdivision(candidate, index):
+        return None
+    return index["countries"].get(candidate.lower())
+
+def match_country(comparison_strings: set | str, index: dict, logger: logging.Logger) -> str | None:
+    """Returns the country name of the first candidate that resolves, or None"""
+    if not isinstance(comparison_strings, set):
+        comparison_strings = set([comparison_strings])
+
+    for string in comparison_strings:
+        match = resolve_country(string, index)
+        if match:
+            logger.debug("Match found with: %s", match)
+            return match
+    return None
+
+def canonical_country(country: str | None, country_code: str | None, index: dict) -> str | None:
+    """Names a country known by its alpha-2 code or name, e.g. from the GRID
+    addresses, as pycountry does, so it reads the same as countries matched
+    from affiliations. Falls back to the name given if neither is indexed.
+    e.g. ('Czech Republic', 'CZ') -> 'Czechia'"""
+    for value in (country_code, country):
+        if isinstance(value, str) and value.lower() in index["countries"]:
+            return index["countries"][value.lower()]
+    return country
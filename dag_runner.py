@@ -0,0 +1,192 @@
+"""Runs pipeline stages as a small DAG, skipping stages whose outputs are
+already up to date and running independent stages concurrently"""
+
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# Key of the state recording whether the last run finished, stage names
+# never start with an underscore
+COMPLETED_KEY = "__completed__"
+
+
+def stage(name: str, func, deps: tuple = (), inputs: tuple = (), outputs: tuple = (), params: dict = None) -> dict:
+    """Describes one stage of a DAG.
+    func is called with a dict of the results of the stages it depends on.
+    inputs and outputs are file paths, fingerprinted to decide whether the
+    stage has to run again. Stages with no outputs return in-memory
+    resources for their dependents, and only run when a dependent does."""
+    return {
+        "name": name,
+        "func": func,
+        "deps": tuple(deps),
+        "inputs": tuple(inputs),
+        "outputs": tuple(outputs),
+        "params": params or {},
+    }
+
+def file_fingerprint(file_path: str) -> str | None:
+    """Cheap fingerprint of a file or directory, from its size and
+    modification time. None if it does not exist."""
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def input_fingerprint(stage_spec: dict) -> str:
+    """Hashes a stage's parameters and the fingerprints of its inputs"""
+    fingerprints = {
+        "params": stage_spec["params"],
+        "inputs": {path: file_fingerprint(path) for path in stage_spec["inputs"]},
+    }
+    serialised = json.dumps(fingerprints, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode("utf-8")).hexdigest()
+
+def load_state(file_path: str, logger: logging.Logger) -> dict:
+    """Loads the record of previously completed stages"""
+    if not os.path.exists(file_path):
+        logger.info("No pipeline state found, every stage will run.")
+        return {}
+    with open(file_path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+def save_state(state: dict, file_path: str) -> None:
+    """Saves the record of completed stages, via a temporary file"""
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+    os.replace(temporary_path, file_path)
+
+def is_up_to_date(stage_spec: dict, state: dict) -> bool:
+    """A stage is up to date if it has outputs, they are unchanged since it
+    last completed, and so are its inputs and parameters"""
+    if not stage_spec["outputs"]:
+        return False
+    record = state.get(stage_spec["name"])
+    if record is None:
+        return False
+    outputs = {path: file_fingerprint(path) for path in stage_spec["outputs"]}
+    return (None not in outputs.values()
+            and record["outputs"] == outputs
+            and record["inputs"] == input_fingerprint(stage_spec))
+
+def last_run_completed(state: dict) -> bool:
+    """True if the last run_dag finished without a stage failing. State
+    saved before this was recorded counts as completed."""
+    return state.get(COMPLETED_KEY, True)
+
+def topological_order(stages: list[dict]) -> list[dict]:
+    """Orders stages so every stage comes after the stages it depends on"""
+    by_name = {stage_spec["name"]: stage_spec for stage_spec in stages}
+    ordered = []
+    visiting = set()
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"Stage dependency cycle through '{name}'")
+        visiting.add(name)
+        for dep in by_name[name]["deps"]:
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+        ordered.append(by_name[name])
+
+    for stage_spec in stages:
+        visit(stage_spec["name"])
+    return ordered
+
+def plan_stages(stages: list[dict], state: dict) -> set[str]:
+    """Returns the names of stages that may need to run: any stage that is not
+    up to date, anything downstream of one, and any resource stage (no
+    outputs) that feeds one of those."""
+    ordered = topological_order(stages)
+    needed = set()
+    for stage_spec in ordered:
+        if not stage_spec["outputs"]:
+            continue
+        if not is_up_to_date(stage_spec, state) or any(dep in needed for dep in stage_spec["deps"]):
+            needed.add(stage_spec["name"])
+
+    for stage_spec in reversed(ordered):
+        if stage_spec["outputs"]:
+            continue
+        dependents = [other for other in stages if stage_spec["name"] in other["deps"]]
+        if not dependents or any(other["name"] in needed for other in dependents):
+            needed.add(stage_spec["name"])
+    return needed
+
+def run_dag(stages: list[dict], state_path: str, logger: logging.Logger, max_workers: int = 4, rerun: tuple = ()) -> dict:
+    """Runs every stage once its dependencies have finished, several at a
+    time when they are independent. Stages whose outputs are up to date are
+    skipped, so rerunning after a failure resumes from the failed stage.
+    Stages named in rerun are run regardless, e.g. to fetch new source data.
+    Returns the results of the stages, raises the first failure."""
+    state = load_state(state_path, logger)
+    for name in rerun:
+        state.pop(name, None)
+    state[COMPLETED_KEY] = False
+    save_state(state, state_path)
+    needed = plan_stages(stages, state)
+    logger.info(f"Stages that may need to run: {sorted(needed)}")
+
+    results = {}
+    finished = set()
+    running = {}
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            if failure is None:
+                for stage_spec in stages:
+                    name = stage_spec["name"]
+                    if name in finished or name in running.values():
+                        continue
+                    if not all(dep in finished for dep in stage_spec["deps"]):
+                        continue
+
+                    if name not in needed or is_up_to_date(stage_spec, state):
+                        logger.info(f"Skipping stage '{name}', it is up to date or not needed.")
+                        results[name] = None
+                        finished.add(name)
+                        continue
+
+                    logger.info(f"Starting stage '{name}'..")
+                    dep_results = {dep: results[dep] for dep in stage_spec["deps"]}
+                    running[executor.submit(stage_spec["func"], dep_results)] = name
+
+            if not running:
+                if failure is None and len(finished) < len(stages):
+                    continue
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                stage_spec = next(spec for spec in stages if spec["name"] == name)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logger.error(f"Stage '{name}' failed!")
+                    logger.error(e)
+                    failure = failure or e
+                    continue
+
+                finished.add(name)
+                if stage_spec["outputs"]:
+                    state[name] = {
+                        "inputs": input_fingerprint(stage_spec),
+                        "outputs": {path: file_fingerprint(path) for path in stage_spec["outputs"]},
+                    }
+                    save_state(state, state_path)
+                logger.info(f"Finished stage '{name}'.")
+
+    if failure is not None:
+        raise failure
+    state[COMPLETED_KEY] = True
+    save_state(state, state_path)
+    return results
@@ -0,0 +1,122 @@
+"""Profiles the quality of a dataframe: how much of each column is missing,
+how many distinct values it holds and which values are most common"""
+
+import os
+import json
+import logging
+import argparse
+import pandas as pd
+import config as c
+import parquet_io
+
+DATA_DIR = c.DATA_DIR
+LOG_DIR = c.LOG_DIR
+REFINED_DATA = c.REFINED_DATA
+QUALITY_REPORT = c.QUALITY_REPORT
+QUALITY_TOP_VALUES = c.QUALITY_TOP_VALUES
+
+SCRIPT_NAME = (os.path.basename(__file__)).split(".")[0]
+LOGGING_LEVEL = c.module_log_level(SCRIPT_NAME)
+
+# Values that stand in for missing data
+EMPTY_VALUE = ""
+UNKNOWN_VALUE = "Unknown"
+
+
+def is_list_column(values: pd.Series) -> bool:
+    """Checks if a column holds lists (e.g. key_words), judged by its first
+    non-null value"""
+    if values.empty:
+        return False
+    first = values.iloc[0]
+    return pd.api.types.is_list_like(first) and not isinstance(first, (str, bytes))
+
+def profile_column(series: pd.Series, top: int) -> dict:
+    """Profiles one column without modifying it. Values are counted once, in
+    a single hashing pass, and every statistic is read off those counts.
+    List columns are profiled by their elements, and count as empty when
+    the list is empty."""
+    non_null = series.dropna()
+    null_count = len(series) - len(non_null)
+
+    if is_list_column(non_null):
+        elements = non_null.explode()
+        empty_count = int(elements.isna().sum())
+        counts = elements.dropna().value_counts()
+    else:
+        counts = non_null.value_counts()
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Categoricals count every category, including ones no row holds
+            counts = counts[counts > 0]
+        empty_count = int(counts.get(EMPTY_VALUE, 0))
+
+    unknown_count = int(counts.get(UNKNOWN_VALUE, 0))
+    missing_count = null_count + empty_count + unknown_count
+
+    return {
+        "dtype": str(series.dtype),
+        "null": null_count,
+        "empty": empty_count,
+        "unknown": unknown_count,
+        "missing": missing_count,
+        "missing_percent": round(missing_count / len(series) * 100, 2) if len(series) else 0.0,
+        "distinct": len(counts),
+        "top_values": [[str(value), int(count)] for value, count in counts.head(top).items()],
+    }
+
+def profile_dataframe(df: pd.DataFrame, top: int, logger: logging.Logger) -> dict:
+    """Profiles every column of a dataframe, logging a summary line for each.
+    The dataframe is left untouched."""
+    logger.info("Checking to see how much data is missing from columns..")
+
+    report = {"rows": len(df), "columns": {}}
+    for col in df.columns:
+        profile = profile_column(df[col], top)
+        report["columns"][col] = profile
+        logger.info(f"{col} missing {profile['missing']} / {len(df)} ({profile['missing_percent']:.2f}%), "
+                    f"{profile['distinct']} distinct values")
+
+    return report
+
+def save_quality_report(report: dict, file_path: str, logger: logging.Logger) -> None:
+    """Saves a quality report as JSON"""
+    logger.info(f"Saving data quality report to {file_path}..")
+    with open(file_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+def report_data_quality(df: pd.DataFrame, logger: logging.Logger,
+                        file_path: str = f"{LOG_DIR}/{QUALITY_REPORT}", top: int = QUALITY_TOP_VALUES) -> dict:
+    """Profiles a dataframe, then logs and saves the report"""
+    report = profile_dataframe(df, top, logger)
+    save_quality_report(report, file_path, logger)
+    return report
+
+
+def main(file_path: str = f"{DATA_DIR}/{REFINED_DATA}", partition: dict = None) -> dict:
+    """Profiles a parquet file or partitioned dataset, the refined data by
+    default. Only the rows of a dataset matching the partition values
+    given, e.g. {"year": "2023"}, are read."""
+
+    # Setup logging
+    logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}", LOGGING_LEVEL)
+    logger.info("---> Logging initiated..")
+
+    logger.info(f"---> Reading {file_path}..")
+    if os.path.isdir(file_path):
+        df = parquet_io.query_dataset(file_path, filter=partition or None)
+    else:
+        df = parquet_io.read_dataframe(file_path)
+
+    logger.info("---> Checking data quality..")
+    return report_data_quality(df, logger)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Report the quality of a parquet file.")
+    parser.add_argument("--file", default=f"{DATA_DIR}/{REFINED_DATA}", help="Parquet file or dataset to profile")
+    parser.add_argument("--year", help="Only profile the refined rows of this publication year")
+    parser.add_argument("--country", help="Only profile the refined rows of this country")
+    args = parser.parse_args()
+
+    partition = {name: value for name, value in (("year", args.year), ("country", args.country)) if value is not None}
+    main(args.file, partition)
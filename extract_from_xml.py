@@ -1,19 +1,49 @@
 import os
+import shutil
+import tempfile
+import argparse
+import multiprocessing
 import xml.etree.ElementTree as ET
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 import config as c
-import cProfile
-import pstats
-from datetime import datetime
+import parquet_io
+import article_ledger
+import article_records
+import affiliation_fields
+import metrics
+from datetime import datetime, date
 import logging
-import re
 
 DATA_DIR =  c.DATA_DIR
 LOG_DIR = c.LOG_DIR
 PUBMED_FILE = c.PUBMED_FILE
-CLEANED_DATA = c.REFINED_DATA
+EXTRACTED_ARTICLES = c.EXTRACTED_ARTICLES
+EXTRACTED_AUTHORSHIPS = c.EXTRACTED_AUTHORSHIPS
+EXTRACT_BATCH_SIZE = c.EXTRACT_BATCH_SIZE
+EXTRACT_WORKERS = c.EXTRACT_WORKERS
+ARTICLE_LEDGER = c.ARTICLE_LEDGER
+SHARDS_PER_WORKER = c.SHARDS_PER_WORKER
+XML_CHUNK_SIZE = c.XML_CHUNK_SIZE
+STREAM_XML = c.STREAM_XML
 SCRIPT_NAME = os.path.basename(__file__)
 
+ARTICLE_START = b"<PubmedArticle>"
+ARTICLE_SET_START = b"<PubmedArticleSet>"
+ARTICLE_SET_END = b"</PubmedArticleSet>"
+
+# Fields taken from the first element with the tag anywhere in an article
+FIRST_TEXT_FIELDS = {"ArticleTitle": "title", "PMID": "pmid"}
+# Fields taken from the first element with the tag under the given parent
+FIRST_CHILD_TEXT_FIELDS = {
+    ("Journal", "Title"): "journal",
+    ("Journal", "ISOAbbreviation"): "iso_abbreviation",
+    ("PubDate", "Year"): "year",
+    ("PubDate", "Month"): "pub_month",
+    ("PubDate", "Day"): "pub_day",
+}
+# Fields taken from the first element with the tag in an article's first MedlineJournalInfo
+MEDLINE_FIELDS = {"Country": "country", "MedlineTA": "medline_ta", "NlmUniqueID": "nlm_unique_id", "ISSNLinking": "issn_linking"}
+
 
 def open_file(file_path: str, logger: logging.Logger) -> str:
     """Opens a file, returns it as a string"""
@@ -39,293 +69,412 @@ def convert_string_to_element_tree(xml_str: str, logger: logging.Logger) -> ET:
         logger.error(e)
         return None
 
-def build_date(day: str, month: str, year: str, logger: logging.Logger) -> datetime:
-    """take strings and build a dattime object with them"""
+def build_date(day: str, month: str, year: str, logger: logging.Logger) -> date | None:
+    """take strings and build a date object with them"""
     logger.debug("Building date..")
     try:
-        pub_date = datetime.strptime(f"{day} {month} {year}", "%d %b %Y")
-        formatted_date = pub_date.strftime("%d-%m-%Y")
-        logger.debug(f"Date created succesfully {str(formatted_date)}")
+        formatted_date = datetime.strptime(f"{day} {month} {year}", "%d %b %Y").date()
+        logger.debug("Date created succesfully %s", formatted_date)
         return formatted_date
     except Exception as e:
         logger.error("Could not build date.")
         logger.error(e)
-        return datetime.strptime("01-01-1970")
-
-def get_mesh_descriptors(article: ET, logger: logging.Logger) -> list[str]:
-    """gets the mesh desriptors for an article"""
-    logger.debug("Getting mesh descriptors..")
-    mesh_descriptors = []
-    try:
-        for mesh_heading in article.findall(".//MeshHeading"):
-            descriptor = mesh_heading.find("DescriptorName")
-            if descriptor is not None:
-                ui = descriptor.attrib.get('UI')
-                if ui and ui.startswith('D'):
-                    mesh_descriptors.append(ui)
-        logger.debug("Retrieved mesh descriptors succesfully:")
-        logger.debug(mesh_descriptors)
-        return mesh_descriptors
-    
-    except Exception as e:
-        logger.error("Could not retrieve mesh descriptors")
-        logger.error(e)
-        return mesh_descriptors
-
-def get_key_words(article: ET, logger: logging.Logger) -> list[str]:
-    """gets key words """
-    logger.debug("Getting key words..")
-    try:
-        keywords = [kw.text for kw in article.findall(".//Keyword")]
-        logging.debug("Retrieved key words succesfully:")
-        logging.debug(keywords)
-        return keywords
-    except Exception as e:
-        logger.error("Could not retrieve key words")
-        logger.error(e)
-        return []
-
-def get_medline_info(article: ET, logger: logging.Logger) -> dict:
-    """Gets the medline info from an article"""
-    logger.debug("Getting medline info..")
-    medline = {}
-    try:
-        medline_info = article.find(".//MedlineJournalInfo")
-        if medline_info is not None:
-            medline['country'] = medline_info.findtext(".//Country")
-            medline['medline_ta'] = medline_info.findtext(".//MedlineTA")
-            medline['nlm_unique_id'] = medline_info.findtext(".//NlmUniqueID")
-            medline['issn_linking'] = medline_info.findtext(".//ISSNLinking")
-        else:
-            medline = {'country': None, 'medline_ta': None, "nlm_unique_id": None, "issn_linking": None}
-
-        logger.debug("Retrieved medline info succesfully:")
-        logger.debug(medline)
-        return medline
-
-    except Exception as e:
-        logger.error("Could not retrieve medline info.")
-        logger.error(e)
-        return medline
-
-def get_authors_and_affiliations(article: ET, logger: logging.Logger) -> tuple:
-    logger.debug("Getting authors and affiliations..")
-    authors = []
-    try:
-        for auth in article.findall(".//Author"):
-            last_name = auth.findtext("./LastName")
-            first_name = auth.findtext("./ForeName")
-            affiliations = [aff.text for aff in auth.findall(".//Affiliation")]
-            authors.append({
-                "first_name": first_name,
-                "last_name": last_name,
-                "affiliations": affiliations,
-            })
-        logger.debug("Retrieved authors and affiliations:")
-        logger.debug(authors)
-        return authors
-    except Exception as e:
-        logger.error("Could not retireve authors and affiliations")
-        logger.error(e)
-        return authors
+        return None
 
-def get_abstract(article: ET, logger: logging.Logger) -> str:
-    """Get the abstract for an article"""
-    logger.info("Getting abstract..")
-    try:
-        abstract_text = " ".join([abstract.text or "" for abstract in article.findall(".//AbstractText")]).strip()
-        logger.debug("Retrieved abstract succesfully:")
-        logger.debug(abstract_text)
-        return abstract_text
-    except Exception as e:
-        logger.error("Could not retrieve abstract.")
-        logger.error(e)
-        return ''
-    
-def extract_postcode(text: str, logger: logging.Logger) -> str | None:
-    """Extract postcode from affiliations if exists"""
-    logger.debug("Checking for postcode..")
-    uk_pattern = re.compile(r'\b[A-Z]{1,2}\d{1,2}\s?\d[A-Z]{2}\b')
-    us_pattern = re.compile(r'\b\d{5}(?:-\d{4})?\b')
-    canadian_pattern = re.compile(r'\b[A-Z]\d[A-Z]\s?\d[A-Z]\d\b')
-
-    patterns = [uk_pattern, us_pattern, canadian_pattern]
-
-    postcode = None
-    for pattern in patterns:
-        postcode = pattern.findall(text)
-        if postcode != None:
-            logger.debug(f"Postcode found: {postcode}")
-            break
-    logger.debug(f"No postcode detected.")
-    return postcode
+def extract_article_fields(article: ET) -> dict:
+    """Walks a PubmedArticle subtree once, in document order, and dispatches
+    on each element's tag to fill in every field the rows need. Each field
+    takes the same element the old './/' searches found, i.e. the first in
+    document order, so the results are unchanged. Text fields that exist
+    but are empty are "", as with findtext."""
+    fields = {
+        "title": None, "journal": None, "iso_abbreviation": None, "year": None,
+        "pub_month": None, "pub_day": None, "pmid": None, "doi": None,
+        "abstract_parts": [], "key_words": [], "mesh_descriptors": [], "authors": [],
+        "country": None, "medline_ta": None, "nlm_unique_id": None, "issn_linking": None,
+    }
+    medline_found = False
+    described_headings = set()
+
+    # Each entry is (element, parent, enclosing author, inside the first MedlineJournalInfo)
+    stack = [(article, None, None, False)]
+    while stack:
+        element, parent, author, in_medline = stack.pop()
+        tag = element.tag
+        parent_tag = parent.tag if parent is not None else None
+
+        if tag in FIRST_TEXT_FIELDS:
+            field = FIRST_TEXT_FIELDS[tag]
+            if fields[field] is None:
+                fields[field] = element.text or ""
+        elif (parent_tag, tag) in FIRST_CHILD_TEXT_FIELDS:
+            field = FIRST_CHILD_TEXT_FIELDS[(parent_tag, tag)]
+            if fields[field] is None:
+                fields[field] = element.text or ""
+        elif tag == "ELocationID":
+            if fields["doi"] is None and element.get("EIdType") == "doi":
+                fields["doi"] = element.text or ""
+        elif tag == "AbstractText":
+            fields["abstract_parts"].append(element.text or "")
+        elif tag == "Keyword":
+            fields["key_words"].append(element.text)
+        elif tag == "DescriptorName":
+            # Only the first DescriptorName of each MeshHeading counts
+            if parent_tag == "MeshHeading" and id(parent) not in described_headings:
+                described_headings.add(id(parent))
+                ui = element.get("UI")
+                if ui and ui.startswith("D"):
+                    fields["mesh_descriptors"].append(ui)
+        elif tag == "Author":
+            author = {"first_name": None, "last_name": None, "affiliations": []}
+            fields["authors"].append(author)
+        elif tag == "Affiliation":
+            if author is not None:
+                author["affiliations"].append(element.text)
+        elif tag == "MedlineJournalInfo":
+            if not medline_found:
+                medline_found = in_medline = True
+        elif in_medline and tag in MEDLINE_FIELDS:
+            field = MEDLINE_FIELDS[tag]
+            if fields[field] is None:
+                fields[field] = element.text or ""
+
+        elif parent_tag == "Author":
+            if tag == "LastName" and author["last_name"] is None:
+                author["last_name"] = element.text or ""
+            elif tag == "ForeName" and author["first_name"] is None:
+                author["first_name"] = element.text or ""
+
+        if len(element):
+            stack.extend((child, element, author, in_medline) for child in reversed(element))
+
+    fields["abstract"] = " ".join(fields.pop("abstract_parts")).strip()
+    return fields
 
 def extract_initials(text: str, logger: logging.Logger) -> str:
     """Gets intials from a name"""
-    logger.debug(f"Getting author initials for {text}..")
-    search_pattern = re.compile(r'\b\w*([A-Z])\w*\b')
-    initials = "".join(search_pattern.findall(text))
-    logger.debug(f"Author intials: {initials}")
+    logger.debug("Getting author initials for %s..", text)
+    initials = affiliation_fields.extract_initials(text)
+    logger.debug("Author intials: %s", initials)
     return initials
 
-
-def extract_postcode(text: str, logger: logging.Logger) -> str | None:
-    """Extract postcode from affiliations if exists"""
-    logger.debug("Checking for postcode..")
-    uk_pattern = re.compile(r'\b[A-Z]{1,2}\d{1,2}\s?\d[A-Z]{2}\b')
-    us_pattern = re.compile(r'\b\d{5}(?:-\d{4})?\b')
-    canadian_pattern = re.compile(r'\b[A-Z]\d[A-Z]\s?\d[A-Z]\d\b')
-
-    patterns = [uk_pattern, us_pattern, canadian_pattern]
-
-    postcode = []
-    for pattern in patterns:
-        postcode = pattern.findall(text)
-        if postcode != []:
-            logger.debug(f"Postcode found: {postcode}")
-            return ", ".join(postcode)
-            break
-    logger.debug(f"No postcode detected.")
-    return None
-
-def extract_email(text: str, logger: logging.Logger) -> str | None:
-
-    logger.debug("Checking for email..")
-    email_pattern = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
-    email = email_pattern.findall(text)
-    if email != []:
-        logger.debug(f"email found: {email}")
-        return ", ".join(email)
+def extract_affiliation_fields(text: str, logger: logging.Logger) -> tuple[str | None, str | None]:
+    """Extract email and postcode from affiliations if they exist"""
+    logger.debug("Checking for email and postcode..")
+    email, postcode = affiliation_fields.extract_fields(text)
+    if email is not None:
+        logger.debug("email found: %s", email)
     else:
         logger.debug("no email identified")
-        return None
-
+    if postcode is not None:
+        logger.debug("Postcode found: %s", postcode)
+    else:
+        logger.debug("No postcode detected.")
+    return email, postcode
 
-def segregate_by_affiliation(authors_and_affiliations: dict, logger: logging.Logger) -> dict:
-    """takes a dict of forename, lastname, and affiliatons,
-    makes a copy of each name per affiliation, returns as dict,
+def segregate_by_affiliation(authors_and_affiliations: list[dict], pmid: str, logger: logging.Logger) -> list[article_records.Authorship]:
+    """takes a list of forenames, lastnames, and affiliatons,
+    makes one authorship record per author affiliation, returns as list,
     also extracts email, postcode, and author intials."""
 
     logger.debug("Creating unique author : affiliation pairs..")
-    author_affiliation_pairs = []
+    authorships = []
     logger.debug(authors_and_affiliations)
     try:
         for entry in authors_and_affiliations:
-            pair = {}
             logger.debug(entry['first_name'])
-            
+
             if entry['affiliations'] == []:
-                logging.debug("Affiliations not given.")
-                entry['affiliations'] = 'None Given'
+                logger.debug("Affiliations not given.")
+                continue
             if entry['first_name'] in [None, "None"]:
-                logging.debug("First name not given.")
+                logger.debug("First name not given.")
                 entry['first_name'] = ''
             if entry['last_name'] in [None, "None"]:
-                logging.debug("Last name not given.")
+                logger.debug("Last name not given.")
                 entry['last_name'] = ''
-            
-            if isinstance(entry['affiliations'], list):
-                for affiliation in entry['affiliations']:
-                    pair["name"] = " ".join([entry["first_name"], entry["last_name"]])
-                    pair["initials"] = extract_initials(pair["name"], logger)
-                    pair['affiliation'] = affiliation
-                    pair['email'] = extract_email(affiliation, logger)
-                    pair['postcode'] = extract_postcode(affiliation, logger)
-                    author_affiliation_pairs.append(pair)
-            else:
-                pair["name"] = " ".join([entry["first_name"], entry["last_name"]])
-                pair['affiliation'] = entry['affiliations']
+
+            name = " ".join([entry["first_name"], entry["last_name"]])
+            initials = extract_initials(name, logger)
+            for affiliation in entry['affiliations']:
+                authorships.append(article_records.Authorship(
+                    pmid, name, initials, affiliation,
+                    *extract_affiliation_fields(affiliation, logger)))
 
         logger.debug("Created one author-affiliation entry for each affiliation..")
-        logger.debug(author_affiliation_pairs)
-        return author_affiliation_pairs
+        return authorships
     except Exception as e:
         logger.error("Could not create unique pairs")
         logger.error(e)
+        return authorships
+
+
+def read_file_in_chunks(file_path: str, chunk_size: int, logger: logging.Logger):
+    """Reads a file in binary chunks so it never has to be held in memory in full"""
+    logger.info(f"Streaming file {file_path} in {chunk_size} byte chunks..")
+    with open(file_path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    logger.info(f"Finished streaming {file_path}.")
+
+def iter_articles(chunks, logger: logging.Logger):
+    """Incrementally parses chunks of PubMed XML, yielding one PubmedArticle
+    element at a time. Each article is cleared from the tree once the caller
+    has finished with it, so memory stays flat regardless of input size."""
+    logger.info("Incrementally parsing XML for PubmedArticle elements..")
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    article_count = 0
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if event == "start":
+                if root is None:
+                    root = element
+                continue
+            if element.tag == "PubmedArticle":
+                article_count += 1
+                yield element
+                element.clear()
+                root.clear()
+
+    parser.close()
+    metrics.count("extract.articles", article_count)
+    logger.info(f"Parsed {article_count} articles.")
+
+def article_to_records(article: ET, logger: logging.Logger) -> tuple[article_records.Article, list[article_records.Authorship]]:
+    """Extracts the required information from a single PubmedArticle,
+    returns the article's record and one authorship record per
+    author/affiliation pair."""
+    logger.debug("Extracting article fields..")
+    fields = extract_article_fields(article)
+    logger.debug("Article title: %s", fields["title"])
+
+    formatted_date = None
+    pub_day, pub_month, pub_year = fields['pub_day'], fields['pub_month'], fields['year']
+    if pub_day and pub_month and pub_year:
+        logger.debug("Attempting to build a date..")
+        formatted_date = build_date(pub_day, pub_month, pub_year, logger)
+
+    record = article_records.Article(
+        fields['pmid'],
+        journal=fields['journal'],
+        iso_abbreviation=fields['iso_abbreviation'],
+        year=fields['year'],
+        doi=fields['doi'],
+        abstract=fields['abstract'],
+        key_words=fields['key_words'],
+        mesh_descriptors=fields['mesh_descriptors'],
+        country=fields['country'],
+        medline_ta=fields['medline_ta'],
+        nlm_unique_id=fields['nlm_unique_id'],
+        issn_linking=fields['issn_linking'],
+        formatted_date=formatted_date,
+    )
+
+    logger.debug("Making unique author affiliations unique..")
+    authorships = segregate_by_affiliation(fields['authors'], record.pmid, logger)
+    return record, authorships
+
+def iter_article_records(file_path: str, logger: logging.Logger, ledger: any = None):
+    """Streams articles from disk one at a time, yielding their
+    (article, authorships) records as they are extracted. If an article
+    ledger is given, articles it has already processed are skipped."""
+    logger.info("Streaming data from XML articles..")
+    chunks = read_file_in_chunks(file_path, XML_CHUNK_SIZE, logger)
+    articles = iter_articles(chunks, logger)
+    if ledger is not None:
+        articles = article_ledger.filter_new_articles(articles, ledger, logger)
+    for article in articles:
+        yield article_to_records(article, logger)
+
+def find_next_marker(file, offset: int, marker: bytes, chunk_size: int) -> int:
+    """Returns the byte offset of the next occurrence of marker at or
+    after offset, or -1 if there is none."""
+    file.seek(offset)
+    overlap = b""
+    position = offset
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return -1
+        window = overlap + chunk
+        found = window.find(marker)
+        if found != -1:
+            return position - len(overlap) + found
+        overlap = window[-(len(marker) - 1):]
+        position += len(chunk)
+
+def find_shard_boundaries(file_path: str, shard_count: int, logger: logging.Logger) -> list[tuple[int, int]]:
+    """Splits a PubMed file into roughly equal byte ranges, each starting on a
+    PubmedArticle tag so that every shard holds whole articles only."""
+    logger.info(f"Splitting {file_path} into {shard_count} shards..")
+
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as file:
+        first_article = find_next_marker(file, 0, ARTICLE_START, XML_CHUNK_SIZE)
+        if first_article == -1:
+            logger.warning("No articles found in file.")
+            return []
+
+        tail_start = max(file_size - XML_CHUNK_SIZE, 0)
+        file.seek(tail_start)
+        set_end = file.read().rfind(ARTICLE_SET_END)
+        end = tail_start + set_end if set_end != -1 else file_size
+
+        starts = [first_article]
+        for shard in range(1, shard_count):
+            target = first_article + (end - first_article) * shard // shard_count
+            start = find_next_marker(file, max(target, starts[-1] + 1), ARTICLE_START, XML_CHUNK_SIZE)
+            if start == -1 or start >= end:
+                break
+            starts.append(start)
+
+    boundaries = list(zip(starts, starts[1:] + [end]))
+    logger.info(f"Created {len(boundaries)} shards.")
+    return boundaries
+
+def read_shard_in_chunks(file_path: str, start: int, end: int, chunk_size: int):
+    """Reads a byte range of a PubMed file, wrapped in a PubmedArticleSet
+    element so that it can be parsed as a document of its own."""
+    yield ARTICLE_SET_START
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    yield ARTICLE_SET_END
+
+def extract_shard(file_path: str, start: int, end: int, articles_path: str, authorships_path: str,
+                  ledger_path: str = None) -> tuple[int, int, list[tuple[str, str]]]:
+    """Worker process entry point, extracts the articles in one byte range
+    of a PubMed file to its own articles and authorships parquet files.
+    Returns the number of articles and authorships, and the (pmid,
+    content_hash) of each article extracted. If a ledger path is given,
+    articles already processed are skipped. The ledger is only read, the
+    parent marks the articles extracted as pending."""
+    logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}")
+    logger.info(f"Extracting shard {start}-{end} to {articles_path} and {authorships_path}..")
+
+    chunks = read_shard_in_chunks(file_path, start, end, XML_CHUNK_SIZE)
+    articles = iter_articles(chunks, logger)
+    ledger = None
+    pending = []
+    if ledger_path is not None:
+        ledger = article_ledger.open_ledger(ledger_path, logger)
+        articles = article_ledger.filter_new_articles(articles, ledger, logger, pending)
+
+    records = (article_to_records(article, logger) for article in articles)
+    article_count, authorship_count = parquet_io.write_article_batches(records, articles_path, authorships_path,
+                                                                       EXTRACT_BATCH_SIZE, logger)
+
+    if ledger is not None:
+        ledger.close()
+
+    # Worker processes exit without running atexit hooks, so write out the
+    # queued log records now
+    c.stop_logging()
+    return article_count, authorship_count, pending
+
+def parallel_extract(file_path: str, articles_path: str, authorships_path: str, workers: int, logger: logging.Logger,
+                     ledger_path: str = None) -> tuple[int, int]:
+    """Extracts a PubMed file across several processes. Each shard is written
+    by a worker to its own parquet files, the parts are then merged in shard
+    order, so the output is the same as a serial run. Returns the number of
+    articles and authorships. If a ledger path is given, the articles the
+    workers extracted are marked pending in one transaction at the end."""
+    logger.info(f"Extracting {file_path} with {workers} workers..")
+
+    boundaries = find_shard_boundaries(file_path, workers * SHARDS_PER_WORKER, logger)
+    parts_dir = tempfile.mkdtemp(prefix="extract_parts_", dir=os.path.dirname(articles_path) or ".")
+    article_parts = [f"{parts_dir}/articles-{index:05d}.parquet" for index in range(len(boundaries))]
+    authorship_parts = [f"{parts_dir}/authorships-{index:05d}.parquet" for index in range(len(boundaries))]
+
+    try:
+        # Workers are spawned rather than forked, as the pipeline may be
+        # loading spacey and the GRID index in another thread meanwhile
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(extract_shard, file_path, start, end, article_part, authorship_part, ledger_path)
+                       for (start, end), article_part, authorship_part in zip(boundaries, article_parts, authorship_parts)]
+            results = [future.result() for future in futures]
+        article_count = sum(articles for articles, _, _ in results)
+        authorship_count = sum(authorships for _, authorships, _ in results)
+
+        if ledger_path is not None:
+            ledger = article_ledger.open_ledger(ledger_path, logger)
+            article_ledger.mark_pending(ledger, [pair for _, _, pending in results for pair in pending], logger)
+            ledger.close()
+
+        logger.info(f"Extracted {article_count} articles and {authorship_count} authorships, merging shards..")
+        parquet_io.merge_parquet_files(article_parts, articles_path, parquet_io.ARTICLES_SCHEMA, logger)
+        parquet_io.merge_parquet_files(authorship_parts, authorships_path, parquet_io.AUTHORSHIPS_SCHEMA, logger)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
 
+    return article_count, authorship_count
 
-def article_to_dataframe(root: ET, logger: logging.Logger) -> pd.DataFrame:
-    """Extracts and prints the required information from the XML."""
-    logger.info("Extracting data from XML article..")
-
-    unique_attributes = {}
-    complete_data_sets = []
-
-    for article in root.findall("PubmedArticle"):
-        logger.info("\n\n------------------------------------------------")
-        logger.info("Extracting simple data..")
-
-        try:
-            title = article.findtext(".//ArticleTitle")
-            logger.info(f"Article title: {title}")
-        except Exception as e:
-            logger.error("Could not retrieved title.")
-            logger.error(e)
-
-        unique_attributes['journal'] = article.findtext(".//Journal/Title")
-        unique_attributes['iso_abbreviation'] = article.findtext(".//Journal/ISOAbbreviation")
-        unique_attributes['year'] = article.findtext(".//PubDate/Year")
-        unique_attributes['pmid'] = article.findtext(".//PMID")
-        unique_attributes['doi'] = article.findtext(".//ELocationID[@EIdType='doi']")
-        unique_attributes['abstract'] = get_abstract(article, logger)
-        unique_attributes['key_words'] = get_key_words(article, logger)
-        unique_attributes['mesh_descriptors'] = get_mesh_descriptors(article, logger)
-        
-        logger.info("Trying to extract authors and their affiliations..")
-        authors_and_affiliations = get_authors_and_affiliations(article, logger)
-        
-        logger.info("Trying to extract medline information..")
-        medline_info = get_medline_info(article, logger)
-        unique_attributes = unique_attributes | medline_info
-
-        logger.info("Trying to extract publication dates..")
-        pub_day = article.findtext(".//PubDate/Day")
-        pub_month = article.findtext(".//PubDate/Month")
-        pub_year = article.findtext(".//PubDate/Year")
-        if pub_day and pub_month and pub_year:
-            try:
-                logger.info("Day, month, year, extracted.")
-                logger.info("Attempting to build a date..")
-                unique_attributes['formatted_date'] = build_date(pub_day, pub_month, pub_year, logger)
-            except Exception as e:
-                unique_attributes['formatted_date'] = None
-                logger.error("Could not build date.")
-                logger.error(e)
-            
-        logger.info("Making unique author affiliations unique..")
-        author_affilation_pairs = segregate_by_affiliation(authors_and_affiliations, logger)
-        
-        for pair in author_affilation_pairs:
-            unified_set = pair | unique_attributes
-            complete_data_sets.append(unified_set)
-
-    for i in complete_data_sets:
-        print("----------")
-        print(i)
-
-    df = pd.DataFrame(complete_data_sets)
-    logger.info("10 Examples of entries:")
-    logger.info(df.head(10))
-    return df
-
-
-def main(file_path):
-
-    performance_logger = c.setup_subtle_logging(f"{LOG_DIR}/{SCRIPT_NAME}_performance")
-    profiler = c.start_monitor()
+
+def main(file_path: str = f"{DATA_DIR}/{PUBMED_FILE}", streaming: bool = STREAM_XML, workers: int = EXTRACT_WORKERS,
+         incremental: bool = False):
+
+    run = metrics.start_run(SCRIPT_NAME)
     logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}")
 
-    xml_content = open_file(file_path, logger)
-    root = convert_string_to_element_tree(xml_content, logger)
-    df = article_to_dataframe(root, logger)
-    
-    df.to_parquet(f'{DATA_DIR}/{CLEANED_DATA}.parquet', engine='pyarrow')
+    articles_path = f'{DATA_DIR}/{EXTRACTED_ARTICLES}'
+    authorships_path = f'{DATA_DIR}/{EXTRACTED_AUTHORSHIPS}'
+
+    # Incremental runs only extract articles not already in the ledger
+    ledger = None
+    ledger_path = None
+    if incremental:
+        ledger_path = f"{DATA_DIR}/{ARTICLE_LEDGER}"
+        ledger = article_ledger.open_ledger(ledger_path, logger)
+        article_ledger.reset_pending(ledger, logger)
+
+    with metrics.span("extract.extract", workers=workers) as extract_span:
+        if workers > 1:
+            article_count, row_count = parallel_extract(file_path, articles_path, authorships_path, workers, logger, ledger_path)
+        else:
+            if streaming or incremental:
+                records = iter_article_records(file_path, logger, ledger)
+            else:
+                xml_content = open_file(file_path, logger)
+                root = convert_string_to_element_tree(xml_content, logger)
+                records = (article_to_records(article, logger) for article in root.findall("PubmedArticle"))
+            article_count, row_count = parquet_io.write_article_batches(records, articles_path, authorships_path,
+                                                                        EXTRACT_BATCH_SIZE, logger)
 
-    c.stop_monitor(SCRIPT_NAME, profiler, performance_logger)
+    logger.info(f"Extracted {article_count} articles with {row_count} author/affiliation rows.")
+    metrics.count("extract.rows", row_count)
+    metrics.rate("extract.rows_per_second", row_count, extract_span.duration)
+
+    if ledger is not None:
+        ledger.close()
+
+    metrics.finish_run(run, logger)
 
 
 if __name__ == "__main__":
-    
-    file_path = f"{DATA_DIR}/{PUBMED_FILE}"
-    main(file_path)
+
+    parser = argparse.ArgumentParser(description="Extract author/affiliation rows from PubMed XML.")
+    parser.add_argument("--file", default=f"{DATA_DIR}/{PUBMED_FILE}", help="PubMed XML file to extract")
+    parser.add_argument("--workers", type=int, default=EXTRACT_WORKERS, help="Number of worker processes")
+    parser.add_argument("--incremental", action="store_true", help="Only extract articles new or changed since the last run")
+    parser.add_argument("--startup-profile", action="store_true", help="Report how long importing this script takes, then exit")
+    parser.add_argument("--profile", action="store_true", help="Record a cProfile profile of the run")
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        print(c.report_import_times("extract_from_xml"))
+    else:
+        metrics.request_profiling(args.profile)
+        main(args.file, workers=args.workers, incremental=args.incremental)
     
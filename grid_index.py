@@ -0,0 +1,284 @@
+"""Compiles the GRID reference data into a versioned index of Arrow IPC
+files, which refinement memory maps instead of parsing the CSVs and
+rebuilding the match indexes on every run.
+
+The index is a directory per version, named after the format version and a
+hash of the source CSVs, so it is rebuilt whenever either changes:
+
+    grid_index/v3-<hash>/institutions.arrow        alias, normalised alias, length, grid_id, institute, country, country_code
+    grid_index/v3-<hash>/institution_tokens.arrow  token, positions of the aliases holding it
+    grid_index/v3-<hash>/countries.arrow           country, length
+    grid_index/v3-<hash>/country_tokens.arrow      token, positions of the countries holding it
+
+The institutions file joins each alias to its institution's GRID id,
+canonical name (from institutes.csv) and country (from addresses.csv), so
+one institution match yields all three. Aliases shared by several
+institutions have no GRID id, see institution_columns.
+
+The files are uncompressed, so their columns are read zero-copy from the
+memory map, and every process that opens them shares one copy of the pages.
+Only the Aho-Corasick automaton is built on load, as it can't be mapped.
+"""
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import unicodedata
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+import numpy as np
+import pandas as pd
+import config as c
+import match_index
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+DATA_DIR = c.DATA_DIR
+LOG_DIR = c.LOG_DIR
+ADDRESSES = c.ADDRESSES
+ALIASES = c.ALIASES
+INSTITUTES = c.INSTITUTES
+GRID_INDEX = c.GRID_INDEX
+
+SCRIPT_NAME = (os.path.basename(__file__)).split(".")[0]
+LOGGING_LEVEL = c.module_log_level(SCRIPT_NAME)
+
+# Bumped whenever what the index files hold changes, so indexes built
+# by older code are rebuilt rather than used
+FORMAT_VERSION = 3
+
+INSTITUTIONS_FILE = "institutions.arrow"
+INSTITUTION_TOKENS_FILE = "institution_tokens.arrow"
+COUNTRIES_FILE = "countries.arrow"
+COUNTRY_TOKENS_FILE = "country_tokens.arrow"
+MANIFEST_FILE = "manifest.json"
+
+
+def normalise_alias(alias: str) -> str:
+    """Normalises an alias for lookups that ignore case, unicode forms and
+    spacing. e.g. ' Université  de  Paris ' -> 'université de paris'"""
+    return " ".join(unicodedata.normalize("NFKC", alias).casefold().split())
+
+def source_fingerprint(file_paths: list[str]) -> str:
+    """Hashes the contents of the source files, missing files included"""
+    digest = hashlib.sha256()
+    for file_path in file_paths:
+        digest.update(os.path.basename(file_path).encode("utf-8"))
+        if os.path.exists(file_path):
+            with open(file_path, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    digest.update(block)
+        else:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+def index_version(aliases_path: str, addresses_path: str, institutes_path: str) -> str:
+    """The version of the index built from the given CSVs, also the name of
+    its directory, e.g. 'v3-3f2a9c0d1b7e4a65'"""
+    return f"v{FORMAT_VERSION}-{source_fingerprint([aliases_path, addresses_path, institutes_path])[:16]}"
+
+def read_optional_csv(file_path: str, columns: tuple[str], missing: str, logger: logging.Logger) -> pd.DataFrame:
+    """Reads a GRID CSV that the index can be built without. A missing file
+    reads as no rows, and missing columns as empty ones."""
+    if os.path.exists(file_path):
+        logger.info(f"Reading GRID data from {file_path}..")
+        table = pd.read_csv(file_path, dtype=str)
+    else:
+        logger.warning(f"{file_path} not found, {missing}.")
+        table = pd.DataFrame(columns=list(columns), dtype=str)
+
+    for column in columns:
+        if column not in table.columns:
+            table[column] = None
+    return table
+
+def read_reference_data(aliases_path: str, addresses_path: str, institutes_path: str,
+                        logger: logging.Logger) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Reads the GRID aliases, addresses and institutes CSVs. Only the aliases
+    are required: without addresses institutions have no country, and
+    without institutes each alias stands as its institution's name."""
+    logger.info(f"Reading GRID aliases from {aliases_path}..")
+    aliases = pd.read_csv(aliases_path, dtype=str)
+    addresses = read_optional_csv(addresses_path, ("grid_id", "country", "country_code"),
+                                  "institutions will have no country", logger)
+    institutes = read_optional_csv(institutes_path, ("grid_id", "name"),
+                                   "aliases will stand as institution names", logger)
+    return aliases, addresses, institutes
+
+def institution_columns(choices: list[str], aliases: pd.DataFrame, addresses: pd.DataFrame, institutes: pd.DataFrame) -> dict:
+    """Maps each alias to its GRID id, and through that to the institution's
+    canonical name and country. An institution with several addresses takes
+    the first. An alias shared by several institutions (e.g. a company's
+    national branches) has no id or name of its own, and only a country if
+    every one of them is in the same country, so refinement matches the
+    country from the affiliation instead. Aliases without a name keep the
+    alias as their name."""
+    pairs = aliases.dropna(subset=["alias", "grid_id"]).drop_duplicates(["alias", "grid_id"])
+    locations = addresses.dropna(subset=["grid_id"]).drop_duplicates("grid_id").set_index("grid_id")
+    names = institutes.dropna(subset=["grid_id", "name"]).drop_duplicates("grid_id").set_index("grid_id")["name"]
+
+    pairs = pairs.assign(country=locations["country"].reindex(pairs["grid_id"]).to_numpy(),
+                         country_code=locations["country_code"].reindex(pairs["grid_id"]).to_numpy())
+    by_alias = pairs.groupby("alias", sort=False)
+    unique = by_alias["grid_id"].transform("size") == 1
+    same_country = (by_alias["country"].transform("nunique", dropna=False) == 1) & pairs["country"].notna()
+    pairs["grid_id"] = pairs["grid_id"].where(unique)
+    pairs["country"] = pairs["country"].where(same_country)
+    pairs["country_code"] = pairs["country_code"].where(same_country)
+    columns = pairs.drop_duplicates("alias").set_index("alias").reindex(choices)
+
+    institute_names = names.reindex(columns["grid_id"])
+    return {
+        "normalised": [normalise_alias(choice) for choice in choices],
+        "grid_id": missing_as_none(columns["grid_id"]),
+        "institute": [name if isinstance(name, str) else choice for choice, name in zip(choices, institute_names)],
+        "country": missing_as_none(columns["country"]),
+        "country_code": missing_as_none(columns["country_code"]),
+    }
+
+def missing_as_none(values: pd.Series) -> list:
+    """Lists a column's values with missing ones as None"""
+    return values.astype(object).where(values.notna(), None).tolist()
+
+def postings_table(postings: dict) -> pa.Table:
+    """Stores token postings as a token column and a list column of
+    positions, whose offsets and values are two flat arrays"""
+    import pyarrow as pa
+
+    tokens = sorted(postings)
+    positions = pa.array([postings[token] for token in tokens], type=pa.list_(pa.int32()))
+    return pa.table({"token": pa.array(tokens, type=pa.string()), "positions": positions})
+
+def write_ipc(table: pa.Table, file_path: str) -> None:
+    """Writes a table as an uncompressed Arrow IPC file, which can be memory mapped"""
+    import pyarrow as pa
+
+    with pa.OSFile(file_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+def read_ipc(file_path: str) -> pa.Table:
+    """Memory maps an Arrow IPC file, the table's buffers point into the map"""
+    import pyarrow as pa
+
+    return pa.ipc.open_file(pa.memory_map(file_path, "r")).read_all()
+
+def build_grid_index(aliases_path: str, addresses_path: str, institutes_path: str, index_dir: str, logger: logging.Logger) -> str:
+    """Compiles the GRID CSVs into a new version of the index, replacing any
+    older versions. Returns the directory of the version built."""
+    import pyarrow as pa
+
+    version = index_version(aliases_path, addresses_path, institutes_path)
+    logger.info(f"Building GRID index {version} in {index_dir}..")
+    aliases, addresses, institutes = read_reference_data(aliases_path, addresses_path, institutes_path, logger)
+
+    institutions = sorted(set(aliases["alias"].dropna()))
+    countries = sorted(set(addresses["country"].dropna()))
+
+    temporary_dir = os.path.join(index_dir, f"{version}.tmp")
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+
+    for choices, columns, choices_file, tokens_file in (
+        (institutions, institution_columns(institutions, aliases, addresses, institutes), INSTITUTIONS_FILE, INSTITUTION_TOKENS_FILE),
+        (countries, {}, COUNTRIES_FILE, COUNTRY_TOKENS_FILE),
+    ):
+        lengths = np.array([match_index.sorted_token_length(choice) for choice in choices], dtype=np.int32)
+        table = pa.table({"choice": pa.array(choices, type=pa.string()), "length": lengths}
+                         | {name: pa.array(values, type=pa.string()) for name, values in columns.items()})
+        write_ipc(table, os.path.join(temporary_dir, choices_file))
+        write_ipc(postings_table(match_index.build_postings(choices)), os.path.join(temporary_dir, tokens_file))
+
+    manifest = {
+        "version": version,
+        "format_version": FORMAT_VERSION,
+        "built": datetime.now(timezone.utc).isoformat(),
+        "sources": {"aliases": aliases_path, "addresses": addresses_path, "institutes": institutes_path},
+        "institutions": len(institutions),
+        "countries": len(countries),
+    }
+    with open(os.path.join(temporary_dir, MANIFEST_FILE), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+
+    version_dir = os.path.join(index_dir, version)
+    shutil.rmtree(version_dir, ignore_errors=True)
+    os.replace(temporary_dir, version_dir)
+    for entry in os.listdir(index_dir):
+        if entry != version and os.path.isdir(os.path.join(index_dir, entry)):
+            logger.info(f"Removing old GRID index {entry}..")
+            shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
+
+    logger.info(f"Built GRID index of {len(institutions)} aliases and {len(countries)} countries.")
+    return version_dir
+
+def load_postings(table: pa.Table) -> dict:
+    """Reads token postings back to a dict of token to positions. Each
+    positions array is a view into the memory mapped file."""
+    positions = table["positions"].combine_chunks()
+    offsets = positions.offsets.to_numpy()
+    values = positions.values.to_numpy()
+    return {token: values[offsets[row]:offsets[row + 1]]
+            for row, token in enumerate(table["token"].to_pylist())}
+
+def load_match_index(choices_table: pa.Table, tokens_table: pa.Table, logger: logging.Logger) -> dict:
+    """Opens a match_index index from its memory mapped choices and tokens"""
+    choices = choices_table["choice"].to_pylist()
+    lengths = choices_table["length"].to_numpy()
+    return match_index.assemble_match_index(choices, lengths, load_postings(tokens_table), logger)
+
+def institution_details(institutions: pa.Table) -> dict:
+    """Maps each alias to its institution's (name, grid_id, country,
+    country_code), any of which but the name may be None"""
+    columns = [institutions[name].to_pylist() for name in ("institute", "grid_id", "country", "country_code")]
+    return dict(zip(institutions["choice"].to_pylist(), zip(*columns)))
+
+def load_grid_index(logger: logging.Logger, aliases_path: str = f"{DATA_DIR}/{ALIASES}",
+                    addresses_path: str = f"{DATA_DIR}/{ADDRESSES}", institutes_path: str = f"{DATA_DIR}/{INSTITUTES}",
+                    index_dir: str = f"{DATA_DIR}/{GRID_INDEX}") -> dict:
+    """Opens the GRID index for the current CSVs, building it first if it is
+    missing or out of date. Returns the institution and country match
+    indexes, the institutions table, each alias' institution details (see
+    institution_details) and the index version."""
+    version = index_version(aliases_path, addresses_path, institutes_path)
+    version_dir = os.path.join(index_dir, version)
+    if not os.path.exists(os.path.join(version_dir, MANIFEST_FILE)):
+        logger.info(f"GRID index {version} not found.")
+        build_grid_index(aliases_path, addresses_path, institutes_path, index_dir, logger)
+
+    logger.info(f"Opening GRID index {version}..")
+    institutions = read_ipc(os.path.join(version_dir, INSTITUTIONS_FILE))
+    countries = read_ipc(os.path.join(version_dir, COUNTRIES_FILE))
+    return {
+        "version": version,
+        "institutions": institutions,
+        "institution_details": institution_details(institutions),
+        "institution_index": load_match_index(institutions, read_ipc(os.path.join(version_dir, INSTITUTION_TOKENS_FILE)), logger),
+        "country_index": load_match_index(countries, read_ipc(os.path.join(version_dir, COUNTRY_TOKENS_FILE)), logger),
+    }
+
+
+def main(aliases_path: str = f"{DATA_DIR}/{ALIASES}", addresses_path: str = f"{DATA_DIR}/{ADDRESSES}",
+         institutes_path: str = f"{DATA_DIR}/{INSTITUTES}", index_dir: str = f"{DATA_DIR}/{GRID_INDEX}") -> str:
+    """Builds the GRID index from the CSVs"""
+
+    # Setup logging
+    logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}", LOGGING_LEVEL)
+    logger.info("---> Logging initiated..")
+
+    logger.info("---> Building GRID index..")
+    return build_grid_index(aliases_path, addresses_path, institutes_path, index_dir, logger)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compile the GRID reference data into a memory mappable index.")
+    parser.add_argument("--aliases", default=f"{DATA_DIR}/{ALIASES}", help="GRID aliases CSV")
+    parser.add_argument("--addresses", default=f"{DATA_DIR}/{ADDRESSES}", help="GRID addresses CSV")
+    parser.add_argument("--institutes", default=f"{DATA_DIR}/{INSTITUTES}", help="GRID institutes CSV")
+    parser.add_argument("--output", default=f"{DATA_DIR}/{GRID_INDEX}", help="Directory the index versions are built in")
+    args = parser.parse_args()
+
+    main(args.aliases, args.addresses, args.institutes, args.output)
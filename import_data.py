@@ -1,23 +1,44 @@
+from __future__ import annotations
+
 import os
+import json
+import argparse
+import shutil
 import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import boto3
-from typing import Tuple, List
+from typing import TYPE_CHECKING, Tuple, List
 import config as c
+import metrics
+
+if TYPE_CHECKING:
+    import boto3
 
 load_dotenv('.env')
 
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
 AWS_REGION = c.AWS_REGION
-
-IMPORT_BUCKET = c.IMPORT_BUCKET
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+
+IMPORT_BUCKET = os.getenv("S3_BUCKET")
+IMPORT_PREFIX = c.IMPORT_PREFIX
+IMPORT_KEY_FILTER = c.IMPORT_KEY_FILTER
+S3_MANIFEST = c.S3_MANIFEST
+S3_MANIFEST_PENDING = c.S3_MANIFEST_PENDING
+S3_DOWNLOAD_WORKERS = c.S3_DOWNLOAD_WORKERS
+S3_CHUNK_SIZE = c.S3_CHUNK_SIZE
 DATA_DIR = c.DATA_DIR
 LOG_DIR = c.LOG_DIR
 PUBMED_FILE = c.PUBMED_FILE
 
 SCRIPT_NAME = (os.path.basename(__file__)).split(".")[0]
-LOGGING_LEVEL = logging.DEBUG
+LOGGING_LEVEL = c.module_log_level(SCRIPT_NAME)
+
+ARTICLE_SET_OPEN = b"<PubmedArticleSet"
+ARTICLE_SET_CLOSE = b"</PubmedArticleSet>"
+DOCTYPE_OPEN = b"<!DOCTYPE"
 
 # Conceal function
 def conceal(string: str) -> str:
@@ -50,17 +71,27 @@ def request_credentials(default_access_key: str,
 def get_client(access_key: str,
                secret_key: str,
                region: str,
-               logger: logging.Logger) -> boto3.client:
+               logger: logging.Logger,
+               endpoint_url: str = None,
+               max_pool_connections: int = S3_DOWNLOAD_WORKERS) -> boto3.client:
+    """Gets an s3 client, endpoint_url points it at an S3 compatible
+    stand-in (e.g. minio or moto) instead of AWS. The connection pool is
+    sized so the client can be shared by every download thread."""
+    import boto3
+    from botocore.config import Config
+
     logger.info("Fetching boto3 client...")
 
     try:
         client = boto3.client('s3',
                               aws_access_key_id=access_key,
                               aws_secret_access_key=secret_key,
-                              region_name=region
+                              region_name=region,
+                              endpoint_url=endpoint_url,
+                              config=Config(max_pool_connections=max_pool_connections)
                               )
         logger.info("Retrieved client successfully.")
-        logger.debug(f"Client: {client}")
+        logger.debug("Client: %s", client)
 
     except Exception as e:
         logger.error("Failed to get client!")
@@ -68,82 +99,186 @@ def get_client(access_key: str,
 
     return client
 
-def list_xml_files(client: boto3.client, bucket: str, logger: logging.Logger) -> List[str]:
-    """Get xml files from an s3 bucket, returns them as a list."""
-    logger.info("Listing XML files in the bucket...")
-
-    try:
-        response = client.list_objects_v2(Bucket=bucket)
-        xml_files = [content['Key'] for content in response.get('Contents', []) if content['Key'].endswith('.xml')]
-        xml_files = [file for file in xml_files if "joshua" in file]
-
-        logger.info(f"Found {len(xml_files)} XML files.")
-        logger.debug(f"XML files: {xml_files}")
-
-
-    except Exception as e:
-        logger.error("Failed to list XML files!")
-        logger.error(f"{e}")
-        xml_files = []
-
-    return xml_files
-
-# Write XML content to a file
-def write_xml_to_file(xml_content: str, file_path: str, logger: logging.Logger) -> None:
-    logger.info(f"Writing XML content to file: {file_path}")
-
-    try:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(xml_content)
-        logger.info(f"Successfully wrote to {file_path}")
-
-    except Exception as e:
-        logger.error(f"Failed to write XML content to {file_path}!")
-        logger.error(f"{e}")
-
-def download_and_merge_xml_files(client: boto3.client, bucket: str, xml_files: List[str], merged_file_path: str, logger: logging.Logger) -> None:
+def list_xml_objects(client: boto3.client, bucket: str, prefix: str, key_filter: str, logger: logging.Logger) -> dict:
+    """Lists every xml object under a prefix, paging through the results so
+    buckets of more than 1000 keys are listed in full. Returns
+    {key: {'etag': .., 'size': .., 'last_modified': ..}} in key order."""
+    logger.info(f"Listing XML objects in the bucket under prefix '{prefix}'...")
+
+    objects = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get('Contents', []):
+            key = content['Key']
+            if key.endswith('.xml') and key_filter in key:
+                objects[key] = {
+                    'etag': content['ETag'],
+                    'size': content['Size'],
+                    'last_modified': content['LastModified'].isoformat(),
+                }
+
+    logger.info(f"Found {len(objects)} XML objects.")
+    return objects
+
+def load_manifest(file_path: str, logger: logging.Logger) -> dict:
+    """Loads the manifest of objects imported by previous runs"""
+    logger.info(f"Loading import manifest {file_path}..")
+    if not os.path.exists(file_path):
+        logger.info("No manifest found, every object is new.")
+        return {}
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_manifest(manifest: dict, file_path: str, logger: logging.Logger) -> None:
+    """Saves the manifest of imported objects, via a temporary file so an
+    interrupted write never leaves a corrupt manifest behind"""
+    logger.info(f"Saving import manifest {file_path}..")
+    temporary_path = f"{file_path}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temporary_path, file_path)
+
+def commit_manifest(manifest_path: str, pending_path: str, logger: logging.Logger) -> None:
+    """Adds the objects recorded by the last import to the manifest. Called
+    once their articles have been refined, so a run that fails before then
+    imports them again."""
+    if not os.path.exists(pending_path):
+        return
+    manifest = load_manifest(manifest_path, logger)
+    manifest.update(load_manifest(pending_path, logger))
+    save_manifest(manifest, manifest_path, logger)
+    os.remove(pending_path)
+
+def select_changed_objects(objects: dict, manifest: dict, logger: logging.Logger) -> List[str]:
+    """Returns the keys of objects that are new, or whose ETag, size or
+    last modified time differ from the manifest"""
+    changed = [key for key, details in objects.items() if manifest.get(key) != details]
+    logger.info(f"{len(changed)} of {len(objects)} XML objects are new or changed.")
+    logger.debug("Changed XML objects: %s", changed)
+    return changed
+
+def strip_xml_wrappers(chunks, header: dict):
+    """Streams the body of a PubMed XML file, i.e. everything between the
+    PubmedArticleSet tags, dropping the prolog, DOCTYPE and wrapper tags on
+    the fly. The DOCTYPE declaration, if any, is stored in header['doctype']."""
+    buffer = b""
+    in_body = False
+
+    for chunk in chunks:
+        buffer += chunk
+        if not in_body:
+            set_start = buffer.find(ARTICLE_SET_OPEN)
+            set_end = buffer.find(b">", set_start) if set_start != -1 else -1
+            if set_end == -1:
+                continue
+            doctype_start = buffer.find(DOCTYPE_OPEN, 0, set_start)
+            if doctype_start != -1:
+                header['doctype'] = buffer[doctype_start:buffer.find(b">", doctype_start) + 1]
+            buffer = buffer[set_end + 1:].lstrip()
+            in_body = True
+
+        # Hold back the trailing whitespace, and before it as many bytes as
+        # the closing tag, which may be what the next chunks complete
+        held_from = len(buffer.rstrip()) - len(ARTICLE_SET_CLOSE)
+        if held_from > 0:
+            yield buffer[:held_from]
+            buffer = buffer[held_from:]
+
+    if not in_body:
+        # No PubmedArticleSet wrapper, keep everything after the prolog
+        prolog_end = buffer.find(b"?>") + 2 if buffer.lstrip().startswith(b"<?xml") else 0
+        buffer = buffer[prolog_end:]
+
+    buffer = buffer.rstrip()
+    if buffer.endswith(ARTICLE_SET_CLOSE):
+        buffer = buffer[:-len(ARTICLE_SET_CLOSE)].rstrip()
+    yield buffer
+
+def download_xml_body(client: boto3.client, bucket: str, xml_file: str, part_path: str, logger: logging.Logger) -> bytes | None:
+    """Streams one S3 object to a part file in chunks, with its prolog and
+    wrapper tags stripped. Returns the object's DOCTYPE declaration, if any."""
+    logger.debug("Downloading: %s..", xml_file)
+    response = client.get_object(Bucket=bucket, Key=xml_file)
+    header = {}
+    with open(part_path, 'wb') as part:
+        for chunk in strip_xml_wrappers(response['Body'].iter_chunks(S3_CHUNK_SIZE), header):
+            part.write(chunk)
+            metrics.count("import.bytes", len(chunk))
+    metrics.count("import.objects")
+    logger.info(f"Downloaded: {xml_file}")
+    return header.get('doctype')
+
+def download_and_merge_xml_files(client: boto3.client, bucket: str, xml_files: List[str], merged_file_path: str,
+                                 logger: logging.Logger, workers: int = S3_DOWNLOAD_WORKERS) -> List[str]:
     """Compiles all the XML fiels to a sinbgle file, however has to
     do some stitching to stop duplication of elements that must appear
-    only once"""
-    logger.info("Downloading and merging XML files..")
+    only once. Objects are streamed to part files by a bounded pool of
+    threads sharing one client, then stitched together in the order given.
+    Returns the keys that were downloaded successfully."""
+    logger.info(f"Downloading and merging XML files with {workers} threads..")
 
-    merged_content = "<PubmedArticleSet>\n"
-    doctype_declaration = None
+    parts_dir = tempfile.mkdtemp(prefix="import_parts_", dir=os.path.dirname(merged_file_path) or ".")
+    part_paths = [f"{parts_dir}/part-{index:05d}.xml" for index in range(len(xml_files))]
 
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(download_xml_body, client, bucket, xml_file, part_path, logger)
+                       for xml_file, part_path in zip(xml_files, part_paths)]
+
+            doctype_declaration = None
+            downloaded = []
+            downloaded_files = []
+            for xml_file, part_path, future in zip(xml_files, part_paths, futures):
+                try:
+                    doctype = future.result()
+                    doctype_declaration = doctype_declaration or doctype
+                    downloaded.append(part_path)
+                    downloaded_files.append(xml_file)
+                except Exception as e:
+                    logger.error(f"Failed to download {xml_file}!")
+                    logger.error(f"{e}")
+
+        logger.info(f"Writing merged XML to file: {merged_file_path}")
+        with open(merged_file_path, 'wb') as merged_file:
+            if doctype_declaration:
+                merged_file.write(doctype_declaration + b"\n")
+            merged_file.write(b"<PubmedArticleSet>\n")
+            for part_path in downloaded:
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, merged_file)
+                merged_file.write(b"\n")
+            merged_file.write(b"</PubmedArticleSet>")
+        logger.info(f"Successfully wrote to {merged_file_path}")
+
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    return downloaded_files
+
+def stream_xml_files(client: boto3.client, bucket: str, xml_files: List[str], logger: logging.Logger):
+    """Streams the articles of several S3 objects, in the order given, as
+    the chunks of a single PubmedArticleSet document. Nothing is written to
+    disk, so the chunks can be fed straight to an incremental parser."""
+    logger.info(f"Streaming {len(xml_files)} XML files..")
+
+    yield b"<PubmedArticleSet>\n"
     for xml_file in xml_files:
-        logger.debug(f"Downloading and merging: {xml_file}..")
-        try:
-            response = client.get_object(Bucket=bucket, Key=xml_file)
-            content = response['Body'].read().decode('utf-8')
-
-            if not doctype_declaration:
-                doctype_pos = content.find('<!DOCTYPE')
-                if doctype_pos != -1:
-                    doctype_end_pos = content.find('>', doctype_pos) + 1
-                    doctype_declaration = content[doctype_pos:doctype_end_pos]
-                    content = content[:doctype_pos] + content[doctype_end_pos:].strip()
-
-            content = content.replace('<?xml version="1.0"?>', '').strip()
-            content = content.replace('<PubmedArticleSet>', '').replace('</PubmedArticleSet>', '').strip()
-
-            merged_content += content + "\n"
-            logger.info(f"Downloaded: {xml_file}")
-
-        except Exception as e:
-            logger.error(f"Failed to download {xml_file}!")
-            logger.error(f"{e}")
-
-    merged_content += "</PubmedArticleSet>"
-
-    if doctype_declaration:
-        merged_content = doctype_declaration + "\n" + merged_content
-
-    write_xml_to_file(merged_content, merged_file_path, logger)
-
-def main():
+        logger.debug("Streaming: %s..", xml_file)
+        response = client.get_object(Bucket=bucket, Key=xml_file)
+        for chunk in strip_xml_wrappers(response['Body'].iter_chunks(S3_CHUNK_SIZE), {}):
+            metrics.count("import.bytes", len(chunk))
+            yield chunk
+        yield b"\n"
+        metrics.count("import.objects")
+        logger.info(f"Streamed: {xml_file}")
+    yield b"</PubmedArticleSet>"
+
+def main(incremental: bool = False) -> List[str]:
+    """Imports the PubMed XML files from S3 into one merged file. When
+    incremental, only objects that are new or changed since the last run
+    (per the manifest) are downloaded. Returns the keys downloaded."""
     # Setup logging and performance tracking
-    performance_logger = c.setup_subtle_logging(f"{LOG_DIR}/{SCRIPT_NAME}_performance")
-    profiler = c.start_monitor()
+    run = metrics.start_run(SCRIPT_NAME)
     logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}", LOGGING_LEVEL)
     logger.info("---> Logging initiated.")
 
@@ -153,19 +288,45 @@ def main():
 
     # Get the S3 client
     logger.info("---> Setting up s3 client..")
-    client = get_client(access_key, secret_key, AWS_REGION, logger)
+    client = get_client(access_key, secret_key, AWS_REGION, logger, S3_ENDPOINT_URL)
 
     # List XML files
-    logger.info("---> Identifying XML files..")    
-    xml_files = list_xml_files(client, IMPORT_BUCKET, logger)
+    logger.info("---> Identifying XML files..")
+    objects = list_xml_objects(client, IMPORT_BUCKET, IMPORT_PREFIX, IMPORT_KEY_FILTER, logger)
+    manifest_path = f'{DATA_DIR}/{S3_MANIFEST}'
+    manifest = load_manifest(manifest_path, logger)
+    if incremental:
+        xml_files = select_changed_objects(objects, manifest, logger)
+    else:
+        xml_files = list(objects)
 
     # Download and merge XML files
     logger.info("---> Downloading and merging XML files..")
     merged_file_path = f'{DATA_DIR}/{PUBMED_FILE}'
-    download_and_merge_xml_files(client, IMPORT_BUCKET, xml_files, merged_file_path, logger)
+    with metrics.span("import.download_and_merge") as download_span:
+        downloaded = download_and_merge_xml_files(client, IMPORT_BUCKET, xml_files, merged_file_path, logger)
+    metrics.rate("import.bytes_per_second", metrics.get_counter("import.bytes"), download_span.duration)
+
+    # Record what was imported. It is only added to the manifest, so the
+    # next incremental run skips it, once refinement has succeeded.
+    logger.info("---> Recording imported objects..")
+    save_manifest({key: objects[key] for key in downloaded}, f'{DATA_DIR}/{S3_MANIFEST_PENDING}', logger)
 
     logger.info("---> Terminating performance tracking and saving data..")
-    c.stop_monitor(SCRIPT_NAME, profiler, performance_logger)
+    metrics.finish_run(run, logger)
+
+    return downloaded
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Import PubMed XML files from S3.")
+    parser.add_argument("--incremental", action="store_true", help="Only download objects new or changed since the last run")
+    parser.add_argument("--startup-profile", action="store_true", help="Report how long importing this script takes, then exit")
+    parser.add_argument("--profile", action="store_true", help="Record a cProfile profile of the run")
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        print(c.report_import_times(SCRIPT_NAME))
+    else:
+        metrics.request_profiling(args.profile)
+        main(args.incremental)
\ No newline at end of file
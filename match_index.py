@@ -0,0 +1,187 @@
+"""Indexed fuzzy matching of candidate strings against a large set of names,
+e.g. the ~19.5k GRID institution aliases"""
+
+from __future__ import annotations
+
+import re
+import logging
+from typing import TYPE_CHECKING
+import numpy as np
+
+if TYPE_CHECKING:
+    import ahocorasick
+
+# Tokens found in more than this share of names (e.g. 'university', 'of')
+# are too common to narrow down a shortlist, so are not indexed
+MAX_TOKEN_SHARE = 0.02
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenise(text: str) -> set[str]:
+    """Splits a string into lowercase word tokens
+    e.g. 'Univ. of Oxford' -> {'univ', 'of', 'oxford'}"""
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+def sorted_token_length(text: str) -> int:
+    """Length of a string as token_sort_ratio sees it, i.e. its
+    whitespace separated tokens joined by single spaces"""
+    return len(" ".join(text.split()))
+
+def build_postings(choices: list[str]) -> dict:
+    """Builds an inverted index from each distinctive token to the positions
+    of the choices containing it"""
+    postings = {}
+    for position, choice in enumerate(choices):
+        for token in tokenise(choice):
+            postings.setdefault(token, []).append(position)
+
+    max_postings = max(1, int(len(choices) * MAX_TOKEN_SHARE))
+    return {token: np.array(positions, dtype=np.int32)
+            for token, positions in postings.items() if len(positions) <= max_postings}
+
+def build_match_index(ideal_strings, logger: logging.Logger) -> dict:
+    """Normalises and tokenises the ideal strings once, and builds an
+    inverted index from token to the positions of the strings containing it."""
+    logger.info("Building fuzzy match index..")
+
+    choices = sorted(ideal for ideal in ideal_strings if isinstance(ideal, str))
+    lengths = np.array([sorted_token_length(choice) for choice in choices], dtype=np.int32)
+    postings = build_postings(choices)
+    return assemble_match_index(choices, lengths, postings, logger)
+
+def assemble_match_index(choices: list[str], lengths: np.ndarray, postings: dict, logger: logging.Logger) -> dict:
+    """Completes a match index from its sorted choices, their lengths and
+    token postings, either just built or loaded prebuilt, by building the
+    exact match automaton over the choices"""
+    automaton = build_automaton(choices, logger)
+
+    logger.info(f"Indexed {len(choices)} strings by {len(postings)} tokens.")
+    return {"choices": choices, "lengths": lengths, "postings": postings, "automaton": automaton}
+
+def build_automaton(choices: list[str], logger: logging.Logger) -> ahocorasick.Automaton | None:
+    """Builds an Aho-Corasick automaton over the choices, which finds every
+    choice occurring in a string in a single scan of that string."""
+    import ahocorasick
+
+    logger.info(f"Building exact match automaton over {len(choices)} strings..")
+    if not choices:
+        return None
+    automaton = ahocorasick.Automaton()
+    for position, choice in enumerate(choices):
+        automaton.add_word(choice, position)
+    automaton.make_automaton()
+    return automaton
+
+def find_perfect_match(comparison_strings: list[str], index: dict) -> str | None:
+    """Returns a choice that occurs exactly within a comparison string, or None.
+    Comparison strings are checked in order and the first with any hit wins,
+    taking its longest (i.e. most specific) hit, the earliest if tied.
+    e.g. 'Dept. of Medicine, University of Oxford' -> 'University of Oxford'
+         rather than 'Oxford'."""
+    automaton = index["automaton"]
+    if automaton is None:
+        return None
+
+    choices = index["choices"]
+    for comparison_string in comparison_strings:
+        best = None
+        best_key = None
+        for end, position in automaton.iter(comparison_string):
+            length = len(choices[position])
+            key = (length, -(end - length + 1))
+            if best_key is None or key > best_key:
+                best, best_key = choices[position], key
+        if best is not None:
+            return best
+    return None
+
+def length_mask(comparison_strings: list[str], index: dict, threshold: int) -> np.ndarray:
+    """Marks the choices long enough and short enough that they could score
+    above threshold against at least one comparison string. A token_sort_ratio
+    between strings of length a and b can be at most 200 * min(a, b) / (a + b)."""
+    lengths = index["lengths"]
+    mask = np.zeros(len(lengths), dtype=bool)
+    for comparison_string in comparison_strings:
+        length = sorted_token_length(comparison_string)
+        best_possible = 200 * np.minimum(lengths, length) / np.maximum(lengths + length, 1)
+        mask |= best_possible > threshold
+    return mask
+
+def shortlist(comparison_strings: list[str], index: dict, threshold: int) -> np.ndarray:
+    """Returns the positions of choices worth scoring: those that share a
+    distinctive token with a comparison string and are of a length that
+    could pass threshold. Falls back to every choice of a possible length
+    when no distinctive tokens are shared."""
+    possible = length_mask(comparison_strings, index, threshold)
+
+    sharing_token = np.zeros(len(possible), dtype=bool)
+    for comparison_string in comparison_strings:
+        for token in tokenise(comparison_string):
+            positions = index["postings"].get(token)
+            if positions is not None:
+                sharing_token[positions] = True
+
+    candidates = possible & sharing_token
+    if not candidates.any():
+        candidates = possible
+    return np.flatnonzero(candidates)
+
+def best_scoring(comparison_strings: list[str], index: dict, positions: np.ndarray, threshold: int) -> tuple[str, float]:
+    """Scores every comparison string against the choices at positions in one
+    batched, multi-threaded call. Returns the best choice scoring above
+    threshold and its score, or ('', -1) if none does."""
+    from rapidfuzz import fuzz, process
+
+    choices = index["choices"]
+    shortlisted = [choices[position] for position in positions]
+    scores = process.cdist(comparison_strings, shortlisted, scorer=fuzz.token_sort_ratio, workers=-1)
+
+    best_str = ""
+    best_score = -1
+    for row in scores:
+        best = int(np.argmax(row))
+        if row[best] > best_score and row[best] > threshold:
+            best_score = row[best]
+            best_str = shortlisted[best]
+    return best_str, best_score
+
+def fuzzy_match_indexed(comparison_strings: set | str, index: dict, threshold: int, logger: logging.Logger) -> str:
+    """Indexed equivalent of refine_data.fuzzy_match. Checks for perfect
+    matches first with an Aho-Corasick scan, then scores every comparison
+    string against its shortlist in one batched, multi-threaded call. If
+    nothing on the shortlist passes, e.g. a typo'd string sharing a token
+    only with the wrong names, every choice of a possible length is scored.
+    Returns the best match scoring above threshold, or 'Unknown'."""
+    logger.debug("Using indexed fuzzy search to find best match with %s..", comparison_strings)
+
+    if not isinstance(comparison_strings, set):
+        comparison_strings = set([comparison_strings])
+    comparison_strings = [string for string in comparison_strings if isinstance(string, str)]
+
+    perfect_match = find_perfect_match(comparison_strings, index)
+    if perfect_match is not None:
+        logger.debug("Perfect match found: %s", perfect_match)
+        return perfect_match
+
+    positions = shortlist(comparison_strings, index, threshold)
+    if not comparison_strings or len(positions) == 0:
+        logger.debug("No good match found.")
+        return "Unknown"
+
+    best_str, best_score = best_scoring(comparison_strings, index, positions, threshold)
+    logger.debug("Scored %s strings against %s shortlisted choices.", len(comparison_strings), len(positions))
+
+    if best_str == "":
+        possible = np.flatnonzero(length_mask(comparison_strings, index, threshold))
+        if len(possible) > len(positions):
+            logger.debug("Nothing shortlisted passed, scoring all %s choices of a possible length.", len(possible))
+            best_str, best_score = best_scoring(comparison_strings, index, possible, threshold)
+
+    if best_str != "":
+        logger.debug("Best accepted match: %s.", best_str)
+        logger.debug("Match score: %s.", best_score)
+        return best_str
+    else:
+        logger.debug("No good match found.")
+        return "Unknown"
@@ -0,0 +1,169 @@
+"""Lightweight run metrics: timed spans, counters, gauges and histograms,
+written as JSON lines at the end of each run so they can be trended"""
+
+import json
+import time
+import uuid
+import logging
+import cProfile
+import threading
+from datetime import datetime, timezone
+from contextlib import ContextDecorator
+import numpy as np
+import config as c
+
+LOG_DIR = c.LOG_DIR
+METRICS_FILE = c.METRICS_FILE
+PROFILE_RUNS = c.PROFILE_RUNS
+
+# Percentiles reported for every histogram
+PERCENTILES = (50, 90, 99)
+
+_lock = threading.Lock()
+_state = {
+    "run_id": None,
+    "depth": 0,
+    "spans": [],
+    "counters": {},
+    "gauges": {},
+    "histograms": {},
+    "profile": PROFILE_RUNS,
+    "profiled_threads": set(),
+}
+
+
+class span(ContextDecorator):
+    """Times a block of code, or every call of a decorated function.
+    The duration is recorded as a span of the current run and added to the
+    '<name>.seconds' histogram.
+    e.g. with metrics.span("refine.ner"): ..  or  @metrics.span("extract.shard")"""
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+
+    def _recreate_cm(self):
+        # Each call of a decorated function gets its own span, so calls in
+        # different threads don't share a start time
+        return span(self.name, **self.attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        record = {"name": self.name, "seconds": round(duration, 6), "thread": threading.current_thread().name}
+        if self.attributes:
+            record["attributes"] = self.attributes
+        with _lock:
+            _state["spans"].append(record)
+            _state["histograms"].setdefault(f"{self.name}.seconds", []).append(duration)
+        self.duration = duration
+        return False
+
+def count(name: str, value: float = 1) -> None:
+    """Adds to a counter, e.g. rows extracted or bytes downloaded"""
+    with _lock:
+        _state["counters"][name] = _state["counters"].get(name, 0) + value
+
+def get_counter(name: str) -> float:
+    """Returns a counter's value in the current run"""
+    with _lock:
+        return _state["counters"].get(name, 0)
+
+def gauge(name: str, value: float) -> None:
+    """Sets a gauge to its latest value, e.g. a rate or a hit ratio"""
+    with _lock:
+        _state["gauges"][name] = value
+
+def observe(name: str, value: float) -> None:
+    """Adds a value to a histogram, e.g. the latency of one batch"""
+    with _lock:
+        _state["histograms"].setdefault(name, []).append(value)
+
+def rate(name: str, amount: float, seconds: float) -> None:
+    """Sets a gauge to amount per second, e.g. rows/sec over a span"""
+    gauge(name, amount / seconds if seconds > 0 else 0.0)
+
+def ratio(name: str, part: float, whole: float) -> None:
+    """Sets a gauge to part / whole, e.g. a cache hit rate"""
+    gauge(name, part / whole if whole else 0.0)
+
+def request_profiling(enabled: bool = True) -> None:
+    """Makes runs started from now on record a cProfile profile, which is
+    otherwise only done when PROFILE_RUNS is set"""
+    _state["profile"] = enabled
+
+def summarise_histogram(values: list[float]) -> dict:
+    """Summarises a histogram by its count, mean, max and percentiles"""
+    array = np.asarray(values, dtype=float)
+    summary = {"count": len(array), "mean": float(array.mean()), "max": float(array.max())}
+    for percentile, value in zip(PERCENTILES, np.percentile(array, PERCENTILES)):
+        summary[f"p{percentile}"] = float(value)
+    return summary
+
+def start_run(name: str) -> dict:
+    """Starts a run of a script. Runs started while another is in progress
+    (e.g. refine_data.main called by the pipeline) are part of that run.
+    The run also records a cProfile profile if profiling was requested."""
+    name = name.split(".")[0]
+    with _lock:
+        owner = _state["depth"] == 0
+        _state["depth"] += 1
+        if owner:
+            _state.update(run_id=uuid.uuid4().hex, spans=[], counters={}, gauges={}, histograms={})
+
+    # cProfile profiles one thread, and only one profiler can be active in it
+    profiler = None
+    thread = threading.get_ident()
+    if _state["profile"] and thread not in _state["profiled_threads"]:
+        _state["profiled_threads"].add(thread)
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    return {"name": name, "owner": owner, "profiler": profiler,
+            "started": datetime.now(timezone.utc).isoformat(), "span": span(f"{name}.run").__enter__()}
+
+def finish_run(run: dict, logger: logging.Logger, file_path: str = f"{LOG_DIR}/{METRICS_FILE}") -> dict | None:
+    """Finishes a run. The run that started first writes every span, then a
+    summary of the counters, gauges and histograms, as JSON lines tagged with
+    the run id. Returns the summary, or None for a run nested in another."""
+    run["span"].__exit__(None, None, None)
+
+    if run["profiler"] is not None:
+        performance_logger = c.setup_subtle_logging(f"{LOG_DIR}/{run['name']}_performance")
+        c.stop_monitor(run["name"], run["profiler"], performance_logger)
+        _state["profiled_threads"].discard(threading.get_ident())
+
+    with _lock:
+        _state["depth"] -= 1
+        if not run["owner"]:
+            return None
+        run_id = _state["run_id"]
+        spans = list(_state["spans"])
+        summary = {
+            "run_id": run_id,
+            "type": "summary",
+            "name": run["name"],
+            "started": run["started"],
+            "seconds": round(run["span"].duration, 6),
+            "counters": dict(_state["counters"]),
+            "gauges": dict(_state["gauges"]),
+            "histograms": {name: summarise_histogram(values)
+                           for name, values in _state["histograms"].items() if values},
+        }
+
+    logger.info(f"Writing {len(spans)} spans and the run summary to {file_path}..")
+    with open(file_path, "a", encoding="utf-8") as file:
+        for record in spans:
+            file.write(json.dumps({"run_id": run_id, "type": "span"} | record) + "\n")
+        file.write(json.dumps(summary) + "\n")
+
+    for name, value in sorted(summary["counters"].items()):
+        logger.info(f"Counter {name}: {value}")
+    for name, value in sorted(summary["gauges"].items()):
+        logger.info(f"Gauge {name}: {value:.3f}")
+    return summary
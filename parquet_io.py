@@ -0,0 +1,295 @@
+"""Writes pipeline rows to parquet in bounded batches, and reads them back.
+Every file is written with the same tuned encodings, compression and sort
+order, see writer_options. Larger outputs are written as hive partitioned
+datasets, which are queried with their filters pushed down to the files."""
+
+import os
+import uuid
+import shutil
+import logging
+from functools import reduce
+from itertools import islice
+import operator
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import config as c
+
+PARQUET_COMPRESSION = c.PARQUET_COMPRESSION
+PARQUET_COMPRESSION_LEVEL = c.PARQUET_COMPRESSION_LEVEL
+PARQUET_ROW_GROUP_SIZE = c.PARQUET_ROW_GROUP_SIZE
+REFINED_PARTITIONS = c.REFINED_PARTITIONS
+
+# Columns with few distinct values, dictionary encoded on disk and read back
+# as categoricals. List columns are dictionary encoded by element, but read
+# back as lists.
+DICTIONARY_COLUMNS = (
+    "name", "initials", "affiliation", "email", "postcode", "journal", "iso_abbreviation", "year",
+    "country", "medline_ta", "nlm_unique_id", "issn_linking", "institution", "grid_id",
+)
+DICTIONARY_LIST_COLUMNS = ("key_words", "mesh_descriptors")
+# Columns of mostly distinct values, which dictionaries don't help. PMIDs
+# are written in numeric order, so neighbouring ones share prefixes, as do
+# DOIs of one journal, and dates are close together, so these are delta
+# encoded. Anything not listed (e.g. abstracts) is stored plain.
+DELTA_ENCODED_COLUMNS = {
+    "pmid": "DELTA_BYTE_ARRAY",
+    "doi": "DELTA_BYTE_ARRAY",
+    "formatted_date": "DELTA_BINARY_PACKED",
+}
+# Each batch or table written is sorted by PMID in numeric order, so one
+# article's rows are stored together. Only each write is sorted, a streamed
+# file's row groups follow the order the articles were extracted in.
+SORT_COLUMN = "pmid"
+
+# Fixed schema for extracted author-affiliation rows, so every row group
+# written agrees on column types regardless of what is in each batch
+EXTRACTED_SCHEMA = pa.schema([
+    ("name", pa.string()),
+    ("initials", pa.string()),
+    ("affiliation", pa.string()),
+    ("email", pa.string()),
+    ("postcode", pa.string()),
+    ("journal", pa.string()),
+    ("iso_abbreviation", pa.string()),
+    ("year", pa.string()),
+    ("pmid", pa.string()),
+    ("doi", pa.string()),
+    ("abstract", pa.string()),
+    ("key_words", pa.list_(pa.string())),
+    ("mesh_descriptors", pa.list_(pa.string())),
+    ("country", pa.string()),
+    ("medline_ta", pa.string()),
+    ("nlm_unique_id", pa.string()),
+    ("issn_linking", pa.string()),
+    ("formatted_date", pa.date32()),
+])
+
+# Normalised extracted tables: each article's fields once, keyed by PMID,
+# and one authorship row per author/affiliation pair referencing it
+ARTICLES_SCHEMA = pa.schema([field for field in EXTRACTED_SCHEMA if field.name not in
+                             ("name", "initials", "affiliation", "email", "postcode")])
+AUTHORSHIPS_SCHEMA = pa.schema([EXTRACTED_SCHEMA.field(name) for name in
+                                ("pmid", "name", "initials", "affiliation", "email", "postcode")])
+
+# Refined rows gain the institution matched from the affiliation and its
+# GRID id, and have 'country' replaced by the institution's country, or the
+# country matched from the affiliation if that isn't known
+REFINED_SCHEMA = EXTRACTED_SCHEMA.append(pa.field("institution", pa.string())).append(pa.field("grid_id", pa.string()))
+
+
+def writer_options(schema: pa.Schema) -> dict:
+    """The ParquetWriter options for a schema: per-column dictionary and
+    delta encodings, zstd compression and column statistics. No sort order
+    is declared, as parquet would take it to be the byte order of the PMID
+    strings, not their numeric order."""
+    names = set(schema.names)
+    return {
+        "compression": PARQUET_COMPRESSION,
+        "compression_level": PARQUET_COMPRESSION_LEVEL,
+        "use_dictionary": [name for name in DICTIONARY_COLUMNS if name in names]
+                          + [f"{name}.list.element" for name in DICTIONARY_LIST_COLUMNS if name in names],
+        "column_encoding": {name: encoding for name, encoding in DELTA_ENCODED_COLUMNS.items() if name in names},
+        "write_statistics": True,
+    }
+
+def open_writer(file_path: str, schema: pa.Schema) -> pq.ParquetWriter:
+    """Opens a ParquetWriter with the tuned options for its schema. Every
+    table or batch written to it must be sorted with sort_by_pmid first."""
+    return pq.ParquetWriter(file_path, schema, **writer_options(schema))
+
+def sort_by_pmid(data: pa.Table | pa.RecordBatch) -> pa.Table | pa.RecordBatch:
+    """Sorts a table or record batch by PMID in numeric order. PMIDs are
+    strings, so they are ordered by length and then by value, which is
+    numeric order without parsing them, e.g. '9' before '10'. The sort is
+    stable, so each article's rows keep their order."""
+    if SORT_COLUMN not in data.schema.names:
+        return data
+    pmids = data.column(SORT_COLUMN)
+    keys = pa.table({"length": pc.utf8_length(pmids), "pmid": pmids})
+    return data.take(pc.sort_indices(keys, [("length", "ascending"), ("pmid", "ascending")]))
+
+def batch_rows(rows, batch_size: int):
+    """Groups an iterable of rows into lists of at most batch_size rows"""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def records_to_record_batch(records: list, schema: pa.Schema, logger: logging.Logger) -> pa.RecordBatch:
+    """Converts a list of records (objects with an attribute per column) to an
+    arrow record batch column by column, without building a dict per row"""
+    logger.debug("Converting %s records to a record batch..", len(records))
+    arrays = [pa.array([getattr(record, field.name) for record in records], type=field.type) for field in schema]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def article_record_batches(records: list[tuple], logger: logging.Logger) -> tuple[pa.RecordBatch, pa.RecordBatch]:
+    """Converts a list of (article, authorships) records to an articles and
+    an authorships record batch"""
+    articles = [article for article, _ in records]
+    authorships = [authorship for _, article_authorships in records for authorship in article_authorships]
+    return (records_to_record_batch(articles, ARTICLES_SCHEMA, logger),
+            records_to_record_batch(authorships, AUTHORSHIPS_SCHEMA, logger))
+
+def write_article_batches(records, articles_path: str, authorships_path: str, batch_size: int,
+                          logger: logging.Logger) -> tuple[int, int]:
+    """Streams (article, authorships) records to an articles and an
+    authorships parquet file, writing one row group to each per batch of
+    batch_size articles. Returns the number of articles and authorships written."""
+    logger.info(f"Writing articles to {articles_path} and authorships to {authorships_path} in batches of {batch_size}..")
+
+    article_count = authorship_count = 0
+    with open_writer(articles_path, ARTICLES_SCHEMA) as articles_writer, \
+         open_writer(authorships_path, AUTHORSHIPS_SCHEMA) as authorships_writer:
+        for batch in batch_rows(records, batch_size):
+            articles, authorships = article_record_batches(batch, logger)
+            articles_writer.write_batch(sort_by_pmid(articles))
+            authorships_writer.write_batch(sort_by_pmid(authorships))
+            article_count += articles.num_rows
+            authorship_count += authorships.num_rows
+            logger.info(f"Wrote row groups, {article_count} articles and {authorship_count} authorships written so far.")
+
+    logger.info(f"Finished writing {article_count} articles and {authorship_count} authorships.")
+    return article_count, authorship_count
+
+def merge_parquet_files(part_paths: list[str], file_path: str, schema: pa.Schema, logger: logging.Logger) -> None:
+    """Concatenates parquet files into one, in the order given, copying
+    one row group at a time so memory is bounded by the largest row group.
+    Each row group is already sorted, so is copied as it is."""
+    logger.info(f"Merging {len(part_paths)} parquet files into {file_path}..")
+
+    with open_writer(file_path, schema) as writer:
+        for part_path in part_paths:
+            part = pq.ParquetFile(part_path)
+            for row_group in range(part.num_row_groups):
+                writer.write_table(part.read_row_group(row_group))
+
+    logger.info(f"Merged parquet files into {file_path}.")
+
+def read_dataframe(file_path: str, columns: list[str] = None) -> pd.DataFrame:
+    """Reads a parquet file to a dataframe, with the dictionary encoded
+    columns as categoricals"""
+    names = pq.read_schema(file_path).names
+    dictionary_columns = [name for name in DICTIONARY_COLUMNS if name in names and (columns is None or name in columns)]
+    return pq.read_table(file_path, columns=columns, read_dictionary=dictionary_columns).to_pandas()
+
+
+def partitioning(schema: pa.Schema, partitions: tuple[str]) -> ds.Partitioning:
+    """Hive partitioning of a dataset by some of its schema's columns,
+    e.g. year=2023/country=Sweden/. Missing values go in a
+    __HIVE_DEFAULT_PARTITION__ directory."""
+    return ds.partitioning(pa.schema([schema.field(name) for name in partitions]), flavor="hive")
+
+def write_partitioned(data: pd.DataFrame | pa.Table, base_dir: str, logger: logging.Logger, schema: pa.Schema = REFINED_SCHEMA,
+                      partitions: tuple[str] = REFINED_PARTITIONS, basename: str = None) -> None:
+    """Adds rows to a hive partitioned parquet dataset, one directory per
+    combination of partition values. Each file is sorted by PMID and written
+    with the tuned options; the partition columns are held in the directory
+    names, not the files. Files are named after basename (random by default),
+    so each write adds files alongside those already there."""
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+    logger.info(f"Writing {data.num_rows} rows to the dataset {base_dir}, partitioned by {', '.join(partitions)}..")
+
+    file_schema = pa.schema([field for field in schema if field.name not in partitions])
+    file_format = ds.ParquetFileFormat()
+    ds.write_dataset(
+        sort_by_pmid(data.select(schema.names)), base_dir,
+        format=file_format,
+        partitioning=partitioning(schema, partitions),
+        file_options=file_format.make_write_options(**writer_options(file_schema)),
+        basename_template=f"{basename or uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        preserve_order=True,
+        max_rows_per_group=PARQUET_ROW_GROUP_SIZE,
+    )
+
+def move_dataset(source_dir: str, base_dir: str) -> None:
+    """Replaces a dataset with one written aside, e.g. to base_dir.tmp"""
+    shutil.rmtree(base_dir, ignore_errors=True)
+    os.replace(source_dir, base_dir)
+
+def replace_dataset(data: pd.DataFrame | pa.Table, base_dir: str, logger: logging.Logger, schema: pa.Schema = REFINED_SCHEMA,
+                    partitions: tuple[str] = REFINED_PARTITIONS) -> None:
+    """Replaces a whole partitioned dataset. The new dataset is written
+    aside first, so the old one is kept if writing fails."""
+    temporary_dir = f"{base_dir}.tmp"
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    write_partitioned(data, temporary_dir, logger, schema, partitions)
+    move_dataset(temporary_dir, base_dir)
+
+def open_dataset(base_dir: str, schema: pa.Schema = REFINED_SCHEMA, partitions: tuple[str] = REFINED_PARTITIONS) -> ds.Dataset:
+    """Opens a hive partitioned parquet dataset. Only the files and row
+    groups a query needs are read, see query_dataset."""
+    dictionary_columns = [name for name in DICTIONARY_COLUMNS if name in schema.names and name not in partitions]
+    read_schema = pa.schema([field.with_type(pa.dictionary(pa.int32(), field.type)) if field.name in dictionary_columns else field
+                             for field in schema])
+    file_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=dictionary_columns))
+    return ds.dataset(base_dir, schema=read_schema, format=file_format, partitioning=partitioning(schema, partitions))
+
+def equals_filter(values: dict) -> ds.Expression:
+    """A filter matching rows whose columns equal the given values, None
+    matching missing values, e.g. {"year": "2023", "country": "Sweden"}"""
+    return reduce(operator.and_, [pc.field(name).is_null() if value is None else pc.field(name) == value
+                                  for name, value in values.items()])
+
+def query_dataset(base_dir: str, columns: list[str] = None, filter: ds.Expression | dict = None,
+                  schema: pa.Schema = REFINED_SCHEMA, partitions: tuple[str] = REFINED_PARTITIONS) -> pd.DataFrame:
+    """Reads only the given columns of the rows matching a filter from a
+    partitioned dataset. Filters on partition columns skip whole
+    directories, and filters on other columns skip row groups by their
+    statistics, e.g. PMIDs, which every file is sorted by. The filter is an
+    expression, or a dict for equals_filter. Dictionary encoded and
+    partition columns are read as categoricals."""
+    if isinstance(filter, dict):
+        filter = equals_filter(filter)
+    table = open_dataset(base_dir, schema, partitions).to_table(columns=columns, filter=filter)
+    return table.to_pandas(categories=[name for name in partitions if name in table.column_names])
+
+def remove_empty_dirs(base_dir: str) -> None:
+    """Removes the empty directories below base_dir, e.g. partitions whose
+    every row has been removed"""
+    for directory, _, _ in os.walk(base_dir, topdown=False):
+        if directory != base_dir and not os.listdir(directory):
+            os.rmdir(directory)
+
+def upsert_partitions(data: pd.DataFrame | pa.Table, base_dir: str, replaced_pmids: list[str], logger: logging.Logger,
+                      schema: pa.Schema = REFINED_SCHEMA, partitions: tuple[str] = REFINED_PARTITIONS) -> int:
+    """Merges rows into a partitioned dataset, rewriting only the partitions
+    that hold new rows or rows of a replaced article (PMID). Every existing
+    row of a replaced article is dropped first, so articles that changed are
+    replaced rather than duplicated. New files are written before the old
+    ones are removed. Returns the number of rows in the dataset."""
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+    if not os.path.exists(base_dir):
+        replace_dataset(data, base_dir, logger, schema, partitions)
+        return data.num_rows
+
+    dataset = open_dataset(base_dir, schema, partitions)
+    replaced = pc.field(SORT_COLUMN).isin(pa.array(replaced_pmids, pa.string()))
+    stale_rows = dataset.to_table(columns=list(partitions), filter=replaced)
+    affected = {tuple(row.values()) for row in stale_rows.to_pylist()} | \
+               {tuple(row.values()) for row in data.select(list(partitions)).to_pylist()}
+    logger.info(f"Rewriting {len(affected)} partitions of the dataset {base_dir}..")
+    if not affected:
+        return dataset.count_rows()
+
+    in_affected = reduce(operator.or_, [equals_filter(dict(zip(partitions, values))) for values in affected])
+    old_files = [fragment.path for fragment in dataset.get_fragments(filter=in_affected)]
+    kept = dataset.to_table(filter=in_affected & ~replaced).cast(schema)
+    logger.info(f"Keeping {kept.num_rows} existing rows of the rewritten partitions.")
+
+    write_partitioned(pa.concat_tables([kept, data.select(schema.names)]), base_dir, logger, schema, partitions)
+    for file_path in old_files:
+        os.remove(file_path)
+    remove_empty_dirs(base_dir)
+
+    # The dataset directory's own modification time marks it as changed
+    os.utime(base_dir)
+    return open_dataset(base_dir, schema, partitions).count_rows()
@@ -5,25 +5,296 @@ This includes importing the raw data, saving it, cleaning it,
 refining it, and pushing it to an S3 bucket.
 """
 import logging
+import argparse
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import os
+import shutil
 import import_data
 import extract_from_xml as extract
 import refine_data as refine
-import export_data 
-from send_email import setup_client, notify 
+import dag_runner as dag
+import parquet_io
+import article_ledger
+import article_records
+import affiliation_cache
+import data_quality
+import metrics
+from send_email import setup_client, notify
 import config as c
 
+try:
+    import export_data
+except ImportError:
+    export_data = None
+
+DATA_DIR = c.DATA_DIR
 LOG_DIR = c.LOG_DIR
+PUBMED_FILE = c.PUBMED_FILE
+EXTRACTED_ARTICLES = c.EXTRACTED_ARTICLES
+EXTRACTED_AUTHORSHIPS = c.EXTRACTED_AUTHORSHIPS
+REFINED_DATA = c.REFINED_DATA
+ADDRESSES = c.ADDRESSES
+INSTITUTES = c.INSTITUTES
+ALIASES = c.ALIASES
+PIPELINE_STATE = c.PIPELINE_STATE
+PIPELINE_WORKERS = c.PIPELINE_WORKERS
+STREAM_QUEUE_SIZE = c.STREAM_QUEUE_SIZE
+EXTRACT_BATCH_SIZE = c.EXTRACT_BATCH_SIZE
+ARTICLE_LEDGER = c.ARTICLE_LEDGER
+AFFILIATION_CACHE = c.AFFILIATION_CACHE
+S3_MANIFEST = c.S3_MANIFEST
+S3_MANIFEST_PENDING = c.S3_MANIFEST_PENDING
 
 SCRIPT_NAME = (os.path.basename(__file__)).split(".")[0]
-LOGGING_LEVEL = logging.DEBUG
+LOGGING_LEVEL = c.module_log_level(SCRIPT_NAME)
+
+# Marks the end of the items on a streaming queue
+END_OF_STREAM = object()
 
 load_dotenv('.env')
 
 
-def main():
+def log_banner(logger: logging.Logger, title: str) -> None:
+    """Logs a section banner"""
+    logger.info("___.----══════=====^^*^^====══════----.___")
+    logger.info(f"||{title:^38}||")
+    logger.info("==========================================")
+
+def build_stages(incremental: bool, logger: logging.Logger) -> list[dict]:
+    """Describes the pipeline as a DAG. Loading the spacey model and GRID
+    reference data does not depend on the data, so runs alongside import
+    and extraction."""
+    merged_file = f"{DATA_DIR}/{PUBMED_FILE}"
+    extracted_files = (f"{DATA_DIR}/{EXTRACTED_ARTICLES}", f"{DATA_DIR}/{EXTRACTED_AUTHORSHIPS}")
+    refined_dir = f"{DATA_DIR}/{REFINED_DATA}"
+    params = {"incremental": incremental}
+
+    def run_import(results):
+        log_banner(logger, "Importing Data")
+        return import_data.main(incremental)
+
+    def run_extract(results):
+        log_banner(logger, "Extracting Data")
+        return extract.main(incremental=incremental)
+
+    def run_load_reference(results):
+        log_banner(logger, "Loading Reference Data")
+        return refine.load_resources(logger)
+
+    def run_refine(results):
+        log_banner(logger, "Refining Data")
+        return refine.main(incremental, results["load_reference"])
+
+    def run_export(results):
+        log_banner(logger, "Exporting Data")
+        return export_data.main()
+
+    stages = [
+        dag.stage("import", metrics.span("pipeline.import")(run_import), outputs=(merged_file,), params=params),
+        dag.stage("extract", metrics.span("pipeline.extract")(run_extract), deps=("import",),
+                  inputs=(merged_file, extract.__file__, c.__file__),
+                  outputs=extracted_files, params=params),
+        dag.stage("load_reference", metrics.span("pipeline.load_reference")(run_load_reference)),
+        dag.stage("refine", metrics.span("pipeline.refine")(run_refine), deps=("extract", "load_reference"),
+                  inputs=(*extracted_files, f"{DATA_DIR}/{ALIASES}", f"{DATA_DIR}/{ADDRESSES}", f"{DATA_DIR}/{INSTITUTES}", refine.__file__, c.__file__),
+                  outputs=(refined_dir,), params=params),
+    ]
+
+    if export_data is not None:
+        stages.append(dag.stage("export", metrics.span("pipeline.export")(run_export), deps=("refine",)))
+    else:
+        logger.warning("export_data module not found, the export stage will not run.")
+
+    return stages
+
+def queue_put(stream: queue.Queue, item: any, stop: threading.Event) -> None:
+    """Puts an item on a bounded queue, waiting for space, unless the
+    pipeline is stopped because another stage failed"""
+    while not stop.is_set():
+        try:
+            stream.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+    raise InterruptedError("Streaming pipeline stopped.")
+
+def queue_iter(stream: queue.Queue, stop: threading.Event):
+    """Yields the items from a queue until the end of the stream, or until
+    the pipeline is stopped because another stage failed"""
+    while not stop.is_set():
+        try:
+            item = stream.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is END_OF_STREAM:
+            return
+        yield item
+    raise InterruptedError("Streaming pipeline stopped.")
+
+def start_stream_stage(name: str, target, output: queue.Queue, stop: threading.Event,
+                       errors: list, logger: logging.Logger) -> threading.Thread:
+    """Runs one streaming stage in its own thread. The end of the stream is
+    passed on when it finishes, and every stage is stopped if it fails."""
+    def run():
+        try:
+            with metrics.span(f"pipeline.stream.{name}"):
+                target()
+            queue_put(output, END_OF_STREAM, stop)
+            logger.info(f"Streaming stage '{name}' finished.")
+        except Exception as e:
+            if not isinstance(e, InterruptedError):
+                logger.error(f"Streaming stage '{name}' failed!")
+                logger.error(e)
+                errors.append(e)
+            stop.set()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def run_streaming(incremental: bool, debug_outputs: bool, logger: logging.Logger) -> None:
+    """Runs import, extract and refine in one process, with no intermediate
+    files. S3 object chunks, articles, row batches and refined batches flow
+    between stages through bounded queues, so every stage runs at once and
+    memory is bounded by the queue sizes. The merged XML and extracted
+    parquet files are only written if debug_outputs is set."""
+    log_banner(logger, "Streaming Pipeline")
+
+    stop = threading.Event()
+    errors = []
+    chunks = queue.Queue(STREAM_QUEUE_SIZE)
+    row_batches = queue.Queue(STREAM_QUEUE_SIZE)
+    refined_batches = queue.Queue(STREAM_QUEUE_SIZE)
+
+    # The spacey model and GRID data load while the first articles stream in
+    resource_loader = ThreadPoolExecutor(max_workers=1)
+    resources = resource_loader.submit(refine.load_resources, logger)
+
+    access_key, secret_key = import_data.request_credentials(import_data.AWS_ACCESS_KEY, import_data.AWS_SECRET_KEY, logger)
+    client = import_data.get_client(access_key, secret_key, import_data.AWS_REGION, logger, import_data.S3_ENDPOINT_URL)
+    objects = import_data.list_xml_objects(client, import_data.IMPORT_BUCKET, import_data.IMPORT_PREFIX,
+                                           import_data.IMPORT_KEY_FILTER, logger)
+    manifest_path = f"{DATA_DIR}/{S3_MANIFEST}"
+    pending_path = f"{DATA_DIR}/{S3_MANIFEST_PENDING}"
+    manifest = import_data.load_manifest(manifest_path, logger)
+    xml_files = import_data.select_changed_objects(objects, manifest, logger) if incremental else list(objects)
+
+    ledger_path = f"{DATA_DIR}/{ARTICLE_LEDGER}"
+    if incremental:
+        ledger = article_ledger.open_ledger(ledger_path, logger)
+        article_ledger.reset_pending(ledger, logger)
+        ledger.close()
+
+    def import_stage():
+        debug_file = open(f"{DATA_DIR}/{PUBMED_FILE}", "wb") if debug_outputs else None
+        try:
+            for chunk in import_data.stream_xml_files(client, import_data.IMPORT_BUCKET, xml_files, logger):
+                if debug_file:
+                    debug_file.write(chunk)
+                queue_put(chunks, chunk, stop)
+        finally:
+            if debug_file:
+                debug_file.close()
+
+    def extract_stage():
+        articles = extract.iter_articles(queue_iter(chunks, stop), logger)
+        ledger = None
+        if incremental:
+            ledger = article_ledger.open_ledger(ledger_path, logger)
+            articles = article_ledger.filter_new_articles(articles, ledger, logger)
+        records = (extract.article_to_records(article, logger) for article in articles)
+
+        writers = None
+        if debug_outputs:
+            writers = (parquet_io.open_writer(f"{DATA_DIR}/{EXTRACTED_ARTICLES}", parquet_io.ARTICLES_SCHEMA),
+                       parquet_io.open_writer(f"{DATA_DIR}/{EXTRACTED_AUTHORSHIPS}", parquet_io.AUTHORSHIPS_SCHEMA))
+        try:
+            for batch in parquet_io.batch_rows(records, EXTRACT_BATCH_SIZE):
+                record_batches = parquet_io.article_record_batches(batch, logger)
+                if writers:
+                    for writer, record_batch in zip(writers, record_batches):
+                        writer.write_batch(parquet_io.sort_by_pmid(record_batch))
+                queue_put(row_batches, record_batches, stop)
+        finally:
+            if writers:
+                for writer in writers:
+                    writer.close()
+            if ledger is not None:
+                ledger.close()
 
+    def refine_stage():
+        loaded = resources.result()
+        cache = affiliation_cache.open_cache(f"{DATA_DIR}/{AFFILIATION_CACHE}", logger)
+        try:
+            for articles, authorships in queue_iter(row_batches, stop):
+                df = refine.add_resolved_affiliations(
+                    article_records.join_tables(articles.to_pandas(), authorships.to_pandas()), loaded["country_index"], loaded["institution_index"],
+                    refine.FUZZY_THRESHOLD_LENIENT, loaded["nlp"], cache, loaded["version"], logger, loaded["institution_details"])
+                queue_put(refined_batches, df, stop)
+        finally:
+            cache.close()
+
+    threads = [
+        start_stream_stage("import", import_stage, chunks, stop, errors, logger),
+        start_stream_stage("extract", extract_stage, row_batches, stop, errors, logger),
+        start_stream_stage("refine", refine_stage, refined_batches, stop, errors, logger),
+    ]
+
+    # Write refined batches as they arrive, to a dataset aside. It then
+    # replaces the refined dataset, or incremental runs merge it in.
+    refined_dir = f"{DATA_DIR}/{REFINED_DATA}"
+    output_dir = f"{refined_dir}.new"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    row_count = 0
+    with metrics.span("pipeline.stream") as stream_span:
+        try:
+            for batch, df in enumerate(queue_iter(refined_batches, stop)):
+                parquet_io.write_partitioned(df, output_dir, logger, basename=f"batch-{batch:05d}")
+                row_count += len(df)
+                logger.info(f"Wrote refined batch, {row_count} rows written so far.")
+        except InterruptedError:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            for thread in threads:
+                thread.join()
+            resource_loader.shutdown(wait=False)
+
+    if errors:
+        raise errors[0]
+
+    if incremental:
+        ledger = article_ledger.open_ledger(ledger_path, logger)
+        new_rows = parquet_io.query_dataset(output_dir)
+        refine.upsert_refined(new_rows, refined_dir, article_ledger.pending_pmids(ledger), logger)
+        article_ledger.commit_pending(ledger, logger)
+        ledger.close()
+        shutil.rmtree(output_dir)
+    else:
+        parquet_io.move_dataset(output_dir, refined_dir)
+
+    import_data.save_manifest({key: objects[key] for key in xml_files}, pending_path, logger)
+    import_data.commit_manifest(manifest_path, pending_path, logger)
+    metrics.count("pipeline.stream.rows", row_count)
+    metrics.rate("pipeline.stream.rows_per_second", row_count, stream_span.duration)
+    logger.info(f"Streaming pipeline refined {row_count} rows.")
+
+
+def main(incremental: bool = False, resume: bool = False, streaming: bool = False, debug_outputs: bool = False):
+    """Runs the whole pipeline. Incremental runs only import, extract and
+    refine the articles that are new or changed since the last run.
+    Resumed runs skip every stage, including the import, whose outputs
+    are up to date. Otherwise the import runs again, unless the last run
+    failed part way, in which case it is resumed.
+    Streaming runs pass data between stages in memory, see run_streaming."""
+
+    run = metrics.start_run(SCRIPT_NAME)
     email_ses = setup_client()
     notify(email_ses, True)
 
@@ -33,36 +304,48 @@ def main():
 
     logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}", LOGGING_LEVEL)
 
-    logger.info("___.----══════=====^^*^^====══════----.___")
-    logger.info("||            Logging Initiated          ||")
-    logger.info("==========================================")
+    log_banner(logger, "Logging Initiated")
     logger.info("")
 
-    logger.info("___.----══════=====^^*^^====══════----.___")
-    logger.info("||             Importing Data            ||")
-    logger.info("==========================================")
-    import_data.main()
+    if streaming:
+        run_streaming(incremental, debug_outputs, logger)
+        log_banner(logger, "Checking Data Quality")
+        data_quality.main()
+        if export_data is not None:
+            log_banner(logger, "Exporting Data")
+            export_data.main()
+    else:
+        # New source data is fetched if the last run completed. A run that
+        # failed part way is resumed instead, so its import and extraction
+        # are not repeated. Stages whose inputs changed rerun either way.
+        stages = build_stages(incremental, logger)
+        state_path = f"{DATA_DIR}/{PIPELINE_STATE}"
+        rerun = ()
+        if not resume:
+            if dag.last_run_completed(dag.load_state(state_path, logger)):
+                rerun = ("import",)
+            else:
+                logger.info("The last run did not complete, resuming it.")
+        dag.run_dag(stages, state_path, logger, PIPELINE_WORKERS, rerun)
 
-    logger.info("___.----══════=====^^*^^====══════----.___")
-    logger.info("||            Extracting Data            ||")
-    logger.info("==========================================")
-    extract.main()
-
-    logger.info("___.----══════=====^^*^^====══════----.___")
-    logger.info("||             Refining Data             ||")
-    logger.info("==========================================")
-    refine.main()
-
-    logger.info("___.----══════=====^^*^^====══════----.___")
-    logger.info("||            Exporting Data             ||")
-    logger.info("==========================================")
-    export_data.main()
-
-    logger.info("___.----══════=====^^*^^====══════----.___")
-    logger.info("||           PIPELINE COMPLETE!          ||")
-    logger.info("==========================================")
+    metrics.finish_run(run, logger)
+    log_banner(logger, "PIPELINE COMPLETE!")
     notify(email_ses, False)
 
 
 if __name__ == "__main__":
-    main()
+
+    parser = argparse.ArgumentParser(description="Run the PubMed pipeline.")
+    parser.add_argument("--incremental", action="store_true", help="Only process articles new or changed since the last run")
+    parser.add_argument("--resume", action="store_true", help="Skip stages whose outputs are up to date, including the import")
+    parser.add_argument("--streaming", action="store_true", help="Stream data between stages in memory, without intermediate files")
+    parser.add_argument("--debug-outputs", action="store_true", help="Also write the intermediate files when streaming")
+    parser.add_argument("--startup-profile", action="store_true", help="Report how long importing this script takes, then exit")
+    parser.add_argument("--profile", action="store_true", help="Record a cProfile profile of each script run")
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        print(c.report_import_times(SCRIPT_NAME))
+    else:
+        metrics.request_profiling(args.profile)
+        main(args.incremental, args.resume, args.streaming, args.debug_outputs)
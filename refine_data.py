@@ -1,60 +1,50 @@
 """Refines the data by extracting more information from the strings in the data parquet"""
 
 import os
+import time
 import logging
-import spacy
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import config as c
-from rapidfuzz import fuzz, process
-import pycountry
+import affiliation_cache
+import article_ledger
+import import_data
+import article_records
+import parquet_io
+import match_index
+import grid_index
+import country_resolver
+import data_quality
+import metrics
 
 DATA_DIR =  c.DATA_DIR
 LOG_DIR = c.LOG_DIR
-CLEANED_DATA = c.EXTRACTED_DATA
+EXTRACTED_ARTICLES = c.EXTRACTED_ARTICLES
+EXTRACTED_AUTHORSHIPS = c.EXTRACTED_AUTHORSHIPS
 REFINED_DATA = c.REFINED_DATA
 ADDRESSES = c.ADDRESSES
 ALIASES = c.ALIASES
+INSTITUTES = c.INSTITUTES
+GRID_INDEX = c.GRID_INDEX
 FUZZY_THRESHOLD_LENIENT = c.FUZZY_THRESHOLD_LENIENT
 SPACEY_DATASET = c.SPACEY_DATASET
+SPACEY_DISABLED = c.SPACEY_DISABLED
+SPACEY_BATCH_SIZE = c.SPACEY_BATCH_SIZE
+SPACEY_N_PROCESS = c.SPACEY_N_PROCESS
 LOW_MEMORY = c.LOW_MEMORY
+AFFILIATION_CACHE = c.AFFILIATION_CACHE
+ARTICLE_LEDGER = c.ARTICLE_LEDGER
+MATCHING_VERSION = c.MATCHING_VERSION
+S3_MANIFEST = c.S3_MANIFEST
+S3_MANIFEST_PENDING = c.S3_MANIFEST_PENDING
 
 SCRIPT_NAME = (os.path.basename(__file__)).split(".")[0]
-LOGGING_LEVEL = logging.DEBUG
-
-
-def import_csv(file_path: str, memory_capacity: bool, logger: logging.Logger) -> pd.DataFrame:
-    """imports a csv to a pandas dataframe"""
-    logger.info("Reading CSV file to datafrmae..")
-    try:
-        df = pd.read_csv(file_path, low_memory=memory_capacity)
-        logger.info("CSV converted to datframe")
-        return df
-    except Exception as e:
-        logger.error("Error reading CSV")
-        logger.error(e)
-
-def extract_countries_set(addresses_df: pd.DataFrame, logger: logging.Logger) -> set:
-    """Extracts countries to a tuple"""
-    logger.info("Building countries set..")
-
-    try:
-        countries = set(addresses_df['country'])
-        logger.info("Countries extracted.")
-        return countries
-    except Exception as e:
-        logger.debug("Error extracting countries.")
-        logger.debug(e)
-
-def extract_insitiutions_set(aliases_df: pd.DataFrame, logger: logging.Logger) -> set:
-    """Extracts insititution names to a tuple"""
-    logger.info("Building institutions set..")
-    try:
-        institutions = set(aliases_df['alias'])
-        logger.info("Institutions extracted.")
-        return institutions
-    except Exception as e:
-        logger.debug("Error extracting institutions.")
-        logger.debug(e)
+LOGGING_LEVEL = c.module_log_level(SCRIPT_NAME)
+
+# Entity labels extracted for the country and institution matchers
+NER_LABELS = ("GPE", "ORG")
 
 
 def fuzzy_match(comparison_strings: set | str, ideal_strings: list | tuple, threshold: int, logger: logging.Logger) -> str:
@@ -64,7 +54,7 @@ def fuzzy_match(comparison_strings: set | str, ideal_strings: list | tuple, thre
     e.g. [Shoreditch, London, Englnd] and [France, England, Germany] -> England
           will return 'England'."""
 
-    logger.debug(f"Using fuzzy search to find best match with {comparison_strings}..")
+    logger.debug("Using fuzzy search to find best match with %s..", comparison_strings)
 
     if not isinstance(comparison_strings, set):
         comparison_strings = set([comparison_strings])
@@ -72,9 +62,11 @@ def fuzzy_match(comparison_strings: set | str, ideal_strings: list | tuple, thre
     for comparison_string in comparison_strings:
         for ideal in ideal_strings:
             if ideal in comparison_string:
-                logger.debug(f"Perfect match found: {ideal}")
+                logger.debug("Perfect match found: %s", ideal)
                 return ideal
     
+    from rapidfuzz import fuzz, process
+
     best_str = ""
     best_score = -1
     for comparison_string in comparison_strings:
@@ -84,52 +76,32 @@ def fuzzy_match(comparison_strings: set | str, ideal_strings: list | tuple, thre
             best_str = match[0]
 
     if best_str != "":
-        logger.debug(f"Best accepted match: {best_str}.")
-        logger.debug(f"Match score: {best_score}.")
+        logger.debug("Best accepted match: %s.", best_str)
+        logger.debug("Match score: %s.", best_score)
         return best_str
     else:
         logger.debug("No good match found.")
         return "Unknown"
 
-def is_subdivision(name: str) -> bool:
+def is_subdivision(name: str, logger: logging.Logger) -> bool:
     """
     Checks if a given name matches a subdivision in any country.
     Stops a state like Maryland MD, being matched to Maldova, MD.
     i.e. stops red-herrings.
     """
-    try:
-        pycountry.subdivisions.lookup(name)
-        return True
-    except LookupError:
-        return False
+    return country_resolver.is_subdivision(name, country_resolver.load_default_index(logger))
 
 def pycountry_match(comparison_strings: set | str, logger: logging.Logger):
     """
     Check elements of a set against the alpha-2, alpha-3, official name,
     and common name of all countries. If any are a 1:1 match,
-    return the official name.
+    return the official name. Uses the prebuilt country_resolver index.
     """
     logger.debug("Searching for matches with pycountry dataset:")
     logger.debug(comparison_strings)
 
-    if not isinstance(comparison_strings, set):
-        comparison_strings = set([comparison_strings])
-
-    for string in comparison_strings:
-
-        if string == 'UK': # The UK is special and is handled here.
-            string = 'GB'
-
-        if is_subdivision(string):
-            continue
-
-        logger.debug(f"Searching for match against: {string}")
-        for country in pycountry.countries:
-            if (string.lower() in {country.alpha_2.lower(), country.alpha_3.lower(), country.name.lower()} or
-                string.lower() in {country.official_name.lower()} if hasattr(country, 'official_name') else False):
-                logger.debug(f"Match found with: {country.name}")
-                return country.name
-    return None
+    index = country_resolver.load_default_index(logger)
+    return country_resolver.match_country(comparison_strings, index, logger)
 
 def spacey_match(comparison_strings: set | str, nlp: any, label: str, logger: logging.Logger) -> set:
     """Takes a string and (using spacey) identifies words in that
@@ -146,7 +118,7 @@ def spacey_match(comparison_strings: set | str, nlp: any, label: str, logger: lo
     possible_matches = set()
 
     for string in comparison_strings:
-        logger.debug(f"Searching for associations with: {string}, using label: {label}")
+        logger.debug("Searching for associations with: %s, using label: %s", string, label)
         doc = nlp(string)
         logger.debug("NLP document:")
         logger.debug(doc)
@@ -159,15 +131,70 @@ def spacey_match(comparison_strings: set | str, nlp: any, label: str, logger: lo
             if ent.label_ == label:
                 possible_matches.add(ent.text)
 
-    logger.debug(f"Possible matches: {possible_matches}")
+    logger.debug("Possible matches: %s", possible_matches)
     return possible_matches
 
-def identify_matching_country(affiliation: str, countries: tuple, threshold: int, nlp: any, logger: logging.Logger):
+def load_nlp(dataset: str, disabled: list[str], logger: logging.Logger) -> any:
+    """Loads a spacey pipeline with the components not needed for
+    named entity recognition disabled."""
+    import spacy
+
+    logger.info(f"Loading spacey dataset {dataset}..")
+    nlp = spacy.load(dataset)
+    to_disable = [pipe for pipe in disabled if pipe in nlp.pipe_names]
+    nlp.select_pipes(disable=to_disable)
+    logger.info(f"Disabled spacey components: {to_disable}")
+    logger.info(f"Active spacey components: {nlp.pipe_names}")
+    return nlp
+
+def start_nlp_warmup(dataset: str, disabled: list[str], logger: logging.Logger) -> Future:
+    """Starts loading the spacey pipeline in a background thread, so the
+    slow model load overlaps with reading the CSVs and parquet. The
+    returned future's result is the loaded pipeline."""
+    logger.info("Warming up spacey in the background..")
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spacey-warmup")
+    future = executor.submit(load_nlp, dataset, disabled, logger)
+    executor.shutdown(wait=False)
+    return future
+
+def extract_entities(affiliations, nlp: any, batch_size: int, n_process: int, logger: logging.Logger) -> dict:
+    """Runs each unique affiliation through spacey exactly once, in batches,
+    and collects the entities for every label in NER_LABELS.
+    e.g. {'Kings College, London': {'GPE': {'London'}, 'ORG': {'Kings College'}}}"""
+    logger.info("Extracting named entities from affiliations..")
+
+    unique_affiliations = list(dict.fromkeys(affiliations))
+    texts = [affiliation for affiliation in unique_affiliations if isinstance(affiliation, str)]
+    logger.info(f"Running {len(texts)} unique affiliations through spacey..")
+
+    entities = {affiliation: {label: set() for label in NER_LABELS} for affiliation in unique_affiliations}
+    with metrics.span("refine.ner", affiliations=len(texts)):
+        docs = nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+        batch_start = time.perf_counter()
+        for position, (affiliation, doc) in enumerate(zip(texts, docs), start=1):
+            for ent in doc.ents:
+                if ent.label_ in NER_LABELS:
+                    entities[affiliation][ent.label_].add(ent.text)
+            # Latency of each batch of affiliations, as the caller sees it
+            if position % batch_size == 0 or position == len(texts):
+                batch_end = time.perf_counter()
+                metrics.observe("refine.ner.batch_seconds", batch_end - batch_start)
+                batch_start = batch_end
+    metrics.count("refine.ner.affiliations", len(texts))
+
+    logger.info("Named entities extracted.")
+    return entities
+
+def identify_matching_country(affiliation: str, countries: tuple | dict, threshold: int, nlp: any, logger: logging.Logger, entities: dict = None):
     """Uses spacey to extract possible countries from a string, tries to match
-    those to a list of countries. Also tries simple fuzzy matching if spacey finds nothing."""
-    logger.debug(f"Attempting to extract country from {affiliation}..")
+    those to a list (or match_index index) of countries. Also tries simple fuzzy matching if spacey finds nothing.
+    Entities already extracted by extract_entities can be passed to skip spacey."""
+    logger.debug("Attempting to extract country from %s..", affiliation)
 
-    possible_countries = spacey_match(affiliation, nlp, "GPE", logger)
+    if entities is not None:
+        possible_countries = entities["GPE"]
+    else:
+        possible_countries = spacey_match(affiliation, nlp, "GPE", logger)
 
     logger.debug("Trying to match spacey output to country..")
 
@@ -180,7 +207,7 @@ def identify_matching_country(affiliation: str, countries: tuple, threshold: int
         logger.debug("Matched Spacey output to PyCountry dataset.")
         return match
 
-    match = fuzzy_match(possible_countries, countries, threshold, logger)
+    match = fuzzy_match_names(possible_countries, countries, threshold, logger)
     if match:
         logger.debug("Fuzzy matched spacey output to list of GRID countries.")
         return match
@@ -189,12 +216,24 @@ def identify_matching_country(affiliation: str, countries: tuple, threshold: int
     return match
 
 
-def identify_matching_institution(affiliation: str, institutions: set[str], threshold: int, nlp: any, logger: logging.Logger) -> str:
+def fuzzy_match_names(comparison_strings: set | str, names: set[str] | dict, threshold: int, logger: logging.Logger) -> str:
+    """Fuzzy matches against either a set of names, or an index of them
+    built by match_index.build_match_index."""
+    if isinstance(names, dict):
+        return match_index.fuzzy_match_indexed(comparison_strings, names, threshold, logger)
+    return fuzzy_match(comparison_strings, names, threshold, logger)
+
+def identify_matching_institution(affiliation: str, institutions: set[str] | dict, threshold: int, nlp: any, logger: logging.Logger, entities: dict = None) -> str:
     """Uses spacey to extract possible institutions from a string, tries to match
-    those to a list of insitutions. Also tries simple fuzzy matching if spacey finds nothing."""
-    logger.debug(f"Attempting to extract institution from {affiliation}..")
+    those to a list (or match_index index) of insitutions. Also tries simple fuzzy
+    matching if spacey finds nothing.
+    Entities already extracted by extract_entities can be passed to skip spacey."""
+    logger.debug("Attempting to extract institution from %s..", affiliation)
 
-    possible_institutions = spacey_match(affiliation, nlp, "ORG", logger)    
+    if entities is not None:
+        possible_institutions = entities["ORG"]
+    else:
+        possible_institutions = spacey_match(affiliation, nlp, "ORG", logger)
 
     logger.debug("Trying to match spacey output to institution..")
 
@@ -202,12 +241,12 @@ def identify_matching_institution(affiliation: str, institutions: set[str], thre
         logger.debug("Country could not be derived from the affiliation data.")
         return 'Unknown'
     
-    match = fuzzy_match(possible_institutions, institutions, threshold, logger)
+    match = fuzzy_match_names(possible_institutions, institutions, threshold, logger)
     if match:
         logger.debug("Fuzzy matched spacey output to list of institutions.")
         return match
 
-    match = fuzzy_match(affiliation, institutions, threshold, logger)
+    match = fuzzy_match_names(affiliation, institutions, threshold, logger)
     if match:
         logger.debug("Matched using simple fuzzy search.")
         return match
@@ -216,95 +255,218 @@ def identify_matching_institution(affiliation: str, institutions: set[str], thre
     return match
 
 
-def add_countries(dataframe: pd.DataFrame, countries: tuple, threshold: int, nlp: any, logger: logging.Logger) -> pd.DataFrame:
-    """Adds a 'country' column to the DataFrame; extracts the country
-    from the affiliations column"""
-    logger.debug("Adding countries..")
-    matched_countries = ()
-    for affiliation in dataframe['affiliation']:
-        logger.debug(f"Extracting country from: {affiliation}")
-        country = identify_matching_country(affiliation, countries, threshold, nlp, logger)
-        logger.debug(f"Country identified as: {country}")
-        matched_countries += (country,)
-    dataframe['country'] = matched_countries
+def match_institution(affiliation: str, institutions: set[str] | dict, details: dict | None, threshold: int, nlp: any,
+                      logger: logging.Logger, entities: dict = None) -> tuple[str, str | None, str | None]:
+    """Matches an affiliation to a GRID institution, and looks the matched
+    alias up in the institution details built by load_resources.
+    Returns (institution name, grid_id, country), the latter two None if
+    unknown. Without details the alias is the name."""
+    alias = identify_matching_institution(affiliation, institutions, threshold, nlp, logger, entities)
+    if details is None or alias not in details:
+        return alias, None, None
+    return details[alias]
+
+def institution_details(grid: dict, logger: logging.Logger) -> dict:
+    """Maps each GRID alias to its institution's (name, grid_id, country),
+    from an index opened by grid_index.load_grid_index. Countries are named
+    as pycountry names them, like those matched from affiliations."""
+    country_index = country_resolver.load_default_index(logger)
+    return {alias: (name, grid_id, country_resolver.canonical_country(country, country_code, country_index))
+            for alias, (name, grid_id, country, country_code) in grid["institution_details"].items()}
+
+def resolve_affiliation(affiliation: str, countries: set | dict, institutions: set | dict, threshold: int, nlp: any,
+                        logger: logging.Logger, entities: dict = None, details: dict = None) -> tuple[str, str, str | None]:
+    """Resolves a single affiliation to a (country, institution, grid_id)
+    triple. The country is the matched institution's, and is only matched
+    from the affiliation itself when the institution's isn't known."""
+    institution, grid_id, country = match_institution(affiliation, institutions, details, threshold, nlp, logger, entities)
+    if country is None:
+        metrics.count("refine.match.country_fallbacks")
+        country = identify_matching_country(affiliation, countries, threshold, nlp, logger, entities)
+    return country, institution, grid_id
+
+def add_resolved_affiliations(dataframe: pd.DataFrame, countries: set | dict, institutions: set | dict, threshold: int,
+                              nlp: any, cache: any, version: str, logger: logging.Logger, details: dict = None) -> pd.DataFrame:
+    """Adds 'country', 'institution' and 'grid_id' columns to the DataFrame.
+    Each unique affiliation is resolved once, results already in the cache
+    are reused, and the results are mapped back onto the rows in one
+    vectorised step. details are the GRID institution details from
+    load_resources, without them grid_id is left empty."""
+    logger.info("Resolving unique affiliations..")
+
+    codes, uniques = pd.factorize(dataframe['affiliation'])
+    keys = [affiliation_cache.normalise_affiliation(affiliation) for affiliation in uniques]
+    logger.info(f"{len(dataframe)} rows share {len(uniques)} unique affiliations.")
+
+    resolutions = affiliation_cache.load_resolutions(cache, version, list(set(keys)), logger)
+
+    pending = {}
+    for key, affiliation in zip(keys, uniques):
+        if key not in resolutions and key not in pending:
+            pending[key] = affiliation
+    logger.info(f"Resolving {len(pending)} affiliations not in the cache..")
+    metrics.count("refine.cache.hits", len(resolutions))
+    metrics.count("refine.cache.misses", len(pending))
+    metrics.ratio("refine.cache.hit_rate", metrics.get_counter("refine.cache.hits"),
+                  metrics.get_counter("refine.cache.hits") + metrics.get_counter("refine.cache.misses"))
+
+    entities = extract_entities(pending.values(), nlp, SPACEY_BATCH_SIZE, SPACEY_N_PROCESS, logger)
+    new_resolutions = {}
+    with metrics.span("refine.match", affiliations=len(pending)):
+        for key, affiliation in pending.items():
+            match_start = time.perf_counter()
+            new_resolutions[key] = resolve_affiliation(affiliation, countries, institutions, threshold, nlp, logger,
+                                                         entities[affiliation], details)
+            metrics.observe("refine.match.affiliation_seconds", time.perf_counter() - match_start)
+    affiliation_cache.store_resolutions(cache, version, new_resolutions, logger)
+    resolutions |= new_resolutions
+
+    unique_countries = np.array([resolutions[key][0] for key in keys] + ['Unknown'], dtype=object)
+    unique_institutions = np.array([resolutions[key][1] for key in keys] + ['Unknown'], dtype=object)
+    unique_grid_ids = np.array([resolutions[key][2] for key in keys] + [None], dtype=object)
+    dataframe['country'] = unique_countries.take(codes)
+    dataframe['institution'] = unique_institutions.take(codes)
+    dataframe['grid_id'] = unique_grid_ids.take(codes)
+    metrics.count("refine.rows", len(dataframe))
+
+    logger.info("Affiliations resolved.")
     return dataframe
 
-def add_institutions(dataframe: pd.DataFrame, institutions: tuple, threshold: int, nlp: any, logger: logging.Logger) -> pd.DataFrame:
-    """Adds an 'institution' column to the DataFrame; extracts the institution
-    from the affiliations column"""
-    logger.debug("Adding institutions..")
-    matched_institutions = ()
-    for affiliation in dataframe['affiliation']:
-        logger.debug(f"Extracting institution from: {affiliation}")
-        institution = identify_matching_institution(affiliation, institutions, threshold, nlp, logger)
-        logger.debug(f"Institution identified as: {institution}")
-        matched_institutions += (institution,)
-    dataframe['institution'] = matched_institutions
-    return dataframe
+def upsert_refined(dataframe: pd.DataFrame, dataset_dir: str, replaced_pmids: list[str], logger: logging.Logger) -> int:
+    """Merges newly refined rows into the refined dataset. Only the partitions
+    holding new rows or rows of a replaced article (PMID) are rewritten, and
+    every existing row of a replaced article is dropped first, so articles
+    that changed are replaced rather than duplicated."""
+    logger.info(f"Merging {len(dataframe)} refined rows into {dataset_dir}..")
+    row_count = parquet_io.upsert_partitions(dataframe, dataset_dir, replaced_pmids, logger)
+    logger.info(f"Refined data now holds {row_count} rows.")
+    return row_count
+
+
+def load_resources(logger: logging.Logger, nlp_future: Future = None) -> dict:
+    """Loads everything refinement needs besides the data itself: the spacey
+    pipeline and the prebuilt GRID index. This is independent of the data,
+    so can be loaded while extraction is running. The spacey pipeline loads
+    in the background while the rest is opened,
+    nlp_future can be passed in if its warmup has already been started."""
 
-def check_report_missing_data(df, logger: logging.Logger):
-    """Checks how much data is missing from the dataframe and logs it."""
-    logger.info("Checking to see how much data is missing from columns..")
+    # Setup natural language processor
+    logger.info("---> Setting up Spacey NLP..")
+    if nlp_future is None:
+        nlp_future = start_nlp_warmup(SPACEY_DATASET, SPACEY_DISABLED, logger)
 
-    for col in df.columns:
+    # Build the pycountry lookup index once, up front
+    logger.info("---> Building pycountry lookup index..")
+    country_resolver.load_default_index(logger)
 
-        df[col] = df[col].astype(str)
+    # Open the GRID countries and institutions index, compiling it from the
+    # CSV files first if they have changed since it was built
+    logger.info("---> Opening GRID countries and institutions index..")
+    grid = grid_index.load_grid_index(logger, f"{DATA_DIR}/{ALIASES}", f"{DATA_DIR}/{ADDRESSES}",
+                                      f"{DATA_DIR}/{INSTITUTES}", f"{DATA_DIR}/{GRID_INDEX}")
 
-        count_empty = (df[col] == "").sum()
-        count_nan = df[col].isna().sum()
-        count_unknown = (df[col] == "Unknown").sum()
 
-        missing_count = count_empty + count_nan + count_unknown
-        missing_percent = (missing_count / len(df)) * 100
+    # Version of the matching config, used to key the affiliation cache
+    version = affiliation_cache.matching_config_version({
+        "matching_version": MATCHING_VERSION,
+        "threshold": FUZZY_THRESHOLD_LENIENT,
+        "spacey_dataset": SPACEY_DATASET,
+        "grid_index": grid["version"],
+    })
 
-        logger.info(f"{col} missing {missing_count} / {len(df)} ({missing_percent:.2f}%)")
+    # Wait for the spacey warmup to finish
+    logger.info("---> Waiting for Spacey NLP to finish loading..")
+    nlp = nlp_future.result()
 
+    return {
+        "nlp": nlp,
+        "country_index": grid["country_index"],
+        "institution_index": grid["institution_index"],
+        "institution_details": institution_details(grid, logger),
+        "version": version,
+    }
 
 
-def main():
+def main(incremental: bool = False, resources: dict = None):
+    """Refines the extracted data. resources, as returned by load_resources,
+    can be passed in if they have already been loaded."""
 
     # Setup logging and perforance tracking
-    performance_logger = c.setup_subtle_logging(f"{LOG_DIR}/{SCRIPT_NAME}_performance")
-    profiler = c.start_monitor()
+    run = metrics.start_run(SCRIPT_NAME)
     logger = c.setup_logging(f"{LOG_DIR}/{SCRIPT_NAME}", LOGGING_LEVEL)
     logger.info("---> Logging initiated..")
 
-    # Get data from parquet
-    logger.info("---> Reading file from parquet..")
-    df = pd.read_parquet(f'{DATA_DIR}/{CLEANED_DATA}')
-
-    # Setup natural language processor
-    logger.info("---> Setting up Spacey NLP..")
-    nlp = spacy.load(SPACEY_DATASET)
-
-    # Get list of countries and instituons from CSV files
-    logger.info("---> Getting GRID countries and institutions data from CSV..")
-    addresses_df = import_csv(f"{DATA_DIR}/{ADDRESSES}", LOW_MEMORY, logger)
-    institutions_df = import_csv(f"{DATA_DIR}/{ALIASES}", LOW_MEMORY, logger)
-    logger.info("---> Converting GRID countries and institutions data to tuples..")
-    countries = extract_countries_set(addresses_df, logger)
-    institutions = extract_insitiutions_set(institutions_df, logger)
-
-    # Add countries and institutions to dataframe
-    logger.info("---> Adding countries to the dataframe..")
-    df = add_countries(df, countries, FUZZY_THRESHOLD_LENIENT, nlp, logger)
-    logger.info("---> Adding institutions to the dataframe..")
-    df = add_institutions(df, institutions, FUZZY_THRESHOLD_LENIENT, nlp, logger)
+    # Get data from parquet, joining each authorship to its article
+    logger.info("---> Reading files from parquet..")
+    df = article_records.join_tables(parquet_io.read_dataframe(f'{DATA_DIR}/{EXTRACTED_ARTICLES}'),
+                                     parquet_io.read_dataframe(f'{DATA_DIR}/{EXTRACTED_AUTHORSHIPS}'))
+
+    # Incremental runs only hold the articles that are new or changed
+    ledger = None
+    if incremental:
+        ledger = article_ledger.open_ledger(f"{DATA_DIR}/{ARTICLE_LEDGER}", logger)
+        if df.empty:
+            logger.info("---> No new or changed articles to refine.")
+            article_ledger.commit_pending(ledger, logger)
+            ledger.close()
+            import_data.commit_manifest(f"{DATA_DIR}/{S3_MANIFEST}", f"{DATA_DIR}/{S3_MANIFEST_PENDING}", logger)
+            metrics.finish_run(run, logger)
+            return
+
+    # Load the spacey pipeline and GRID reference data, unless preloaded.
+    # Only now there is data to refine is the slow spacey warmup started.
+    if resources is None:
+        with metrics.span("refine.load_resources"):
+            resources = load_resources(logger, start_nlp_warmup(SPACEY_DATASET, SPACEY_DISABLED, logger))
+
+    # Open the cache of affiliations resolved by previous runs
+    logger.info("---> Opening affiliation cache..")
+    cache = affiliation_cache.open_cache(f"{DATA_DIR}/{AFFILIATION_CACHE}", logger)
+
+    # Add countries and institutions to dataframe, resolving each unique
+    # affiliation once
+    logger.info("---> Adding countries and institutions to the dataframe..")
+    with metrics.span("refine.resolve") as resolve_span:
+        df = add_resolved_affiliations(df, resources["country_index"], resources["institution_index"], FUZZY_THRESHOLD_LENIENT,
+                                       resources["nlp"], cache, resources["version"], logger, resources["institution_details"])
+    metrics.rate("refine.rows_per_second", len(df), resolve_span.duration)
+    cache.close()
 
     logger.info("---> Checking data quality..")
-    check_report_missing_data(df, logger)
+    data_quality.report_data_quality(df, logger)
+
+    if incremental:
+        logger.info("---> Merging new rows into the refined dataset..")
+        replaced_pmids = article_ledger.pending_pmids(ledger)
+        upsert_refined(df, f'{DATA_DIR}/{REFINED_DATA}', replaced_pmids, logger)
+        article_ledger.commit_pending(ledger, logger)
+        ledger.close()
+    else:
+        logger.info("---> Saving dataframe as a partitioned parquet dataset..")
+        parquet_io.replace_dataset(df, f'{DATA_DIR}/{REFINED_DATA}', logger)
 
-    logger.info("---> Saving dataframe as parquet..")
-    df.to_parquet(f'{DATA_DIR}/{REFINED_DATA}', engine='pyarrow')
+    # The imported articles are all refined, so later imports can skip them
+    logger.info("---> Updating import manifest..")
+    import_data.commit_manifest(f"{DATA_DIR}/{S3_MANIFEST}", f"{DATA_DIR}/{S3_MANIFEST_PENDING}", logger)
 
     # Stop tracking performance and save data
     logger.info("---> Terminating performance tracking and saving data..")
-    c.stop_monitor(SCRIPT_NAME, profiler, performance_logger)
+    metrics.finish_run(run, logger)
 
 
     
-    logging.info("---> Done.")
+    logger.info("---> Done.")
 
 if __name__ == "__main__":
 
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Refine extracted PubMed data.")
+    parser.add_argument("--incremental", action="store_true", help="Merge new rows into the existing refined data")
+    parser.add_argument("--startup-profile", action="store_true", help="Report how long importing this script takes, then exit")
+    parser.add_argument("--profile", action="store_true", help="Record a cProfile profile of the run")
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        print(c.report_import_times(SCRIPT_NAME))
+    else:
+        metrics.request_profiling(args.profile)
+        main(args.incremental)
\ No newline at end of file
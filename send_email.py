@@ -2,7 +2,6 @@
 
 import os
 from dotenv import load_dotenv
-from boto3 import client
 import argparse
 
 load_dotenv()
@@ -43,6 +42,7 @@ def get_args():
     return parser.parse_args()
 
 def setup_client():
+    from boto3 import client
     ses = client("ses", aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY)
     return ses
 